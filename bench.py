@@ -0,0 +1,327 @@
+"""Benchmarks for the command path of the bot. This generates synthetic server directories with 10 to
+10,000 servers, with and without metadata files, and loads a fresh copy of the bot for each of them
+without connecting to Discord, with the same helpers as the tests. Half of the servers are registered
+as running against a fake process table. The functions and commands behind .run and .helpme are then
+driven through a stub context, and for each of them the throughput, the median and 99th percentile
+latency, the peak memory and the longest time the event loop was blocked are reported. The results are compared to a stored
+baseline, and the script exits with an error if any of them got worse by more than the tolerance.
+
+Run the benchmarks and compare them to the baseline:
+    python bench.py
+
+Store the results as the new baseline, after a change that is meant to make things slower, or when
+benchmarking on a different machine:
+    python bench.py --save
+"""
+
+# Import
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+from os import path
+import psutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+from tests import support
+
+dir_path = path.dirname(path.realpath(__file__)) # Get the full path of the directory that this file is contained in
+
+START_SCRIPT = 'exit /b 0\n' if os.name == 'nt' else 'exit 0\n' # The contents of the start file. Servers exit right away, so only the cost of starting them is measured
+METADATA = {'description': 'Synthetic server {name}', 'version': '1.20.1', 'mods': 'Vanilla', 'memory': '1M'} # The metadata of the synthetic servers
+FAKE_PID_BASE = 2 ** 22 # The first fake PID. This is above the highest PID any OS hands out, so fake processes are never confused with real ones
+
+SLACK = {'p50': 0.002, 'p99': 0.002, 'mean': 0.002, 'blocked': 0.002, 'peak_memory': 262144} # Differences smaller than these are noise, and never count as a regression
+P99_MIN_ITERATIONS = 100 # The 99th percentile of fewer samples than this is about the slowest one, which is too noisy to compare
+MIN_REPEAT = 3 # The fewest runs whose best results are stable enough to compare or store as a baseline
+
+class FakeProcess:
+    """A process in the fake process table. Only what the process registry uses is implemented."""
+
+    def __init__(self, pid, created):
+        """Initialize the variables."""
+        self.pid = pid # The PID of the process
+        self.created = created # The time the process was created at
+
+    def create_time(self):
+        """Get the time the process was created at."""
+        return self.created # Return the creation time
+
+class FakeProcessTable:
+    """A table of fake processes. While it is installed, the bot sees the fake processes as alive
+    alongside the real ones, so servers can be registered as running without running anything."""
+
+    def __init__(self, size):
+        """Initialize the variables. Every fake process gets a PID and creation time of its own."""
+        self.processes = {FAKE_PID_BASE + index: 1e9 + index for index in range(size)} # A dictionary of fake PIDs to their creation times
+        self.pid_exists = psutil.pid_exists # The real pid_exists, for real processes
+        self.process = psutil.Process # The real Process, for real processes
+
+    def fake_pid_exists(self, pid):
+        """Check if a PID exists, in the fake process table or for real."""
+        return pid in self.processes or self.pid_exists(pid) # Check the fake process table first
+
+    def fake_process(self, pid):
+        """Get a process, from the fake process table or for real."""
+        if pid in self.processes: # Check if the process is fake
+            return FakeProcess(pid, self.processes[pid]) # If so, return the fake process
+        return self.process(pid) # Otherwise, return the real process
+
+    def register(self, registry, names):
+        """Register servers as running in a process registry, each with a process of its own from the
+        table."""
+        for pid, name in zip(self.processes, names): # Loop through each server, along with a fake process
+            registry.processes[name] = {'pid': pid, 'create_time': self.processes[pid]} # Register the server with the fake process
+
+    @contextlib.contextmanager
+    def installed(self, bot):
+        """Make a bot see the fake process table while in the with block. The bot gets a psutil of its
+        own, since psutil itself relies on Process being the real class."""
+        fake = types.ModuleType('psutil') # Create a psutil for the bot
+        fake.__dict__.update(psutil.__dict__) # that has everything the real one has...
+        fake.pid_exists, fake.Process = self.fake_pid_exists, self.fake_process # except that it knows about the fake processes
+        bot.psutil = fake # Give it to the bot
+        try: # Make sure the bot gets the real psutil back
+            yield self
+        finally:
+            bot.psutil = psutil # Give the bot the real psutil back
+
+def make_tree(root, count, metadata):
+    """Generate a server directory with count servers in it. Every server has a start file, and if
+    metadata is set, a metadata file too. The names of the servers are returned in order."""
+    names = [f'server{index:05}' for index in range(count)] # Name the servers so they sort in order
+    for name in names: # Loop through each server
+        support.make_server(root, name, START_SCRIPT, {key: value.format(name=name) for key, value in METADATA.items()} if metadata else None) # Create the server, with metadata if it should have it
+
+    return names # Return the names of the servers
+
+async def watch_loop(blocked, interval=0.001):
+    """Measure how long the event loop is blocked. This sleeps for a short interval over and over, and
+    stores the longest it woke up late in blocked['max']."""
+    loop = asyncio.get_running_loop() # Get the event loop this is running in
+    while True: # Keep measuring until cancelled
+        before = loop.time() # Get the time before sleeping
+        await asyncio.sleep(interval) # Sleep for the interval
+        blocked['max'] = max(loop.time() - before - interval, blocked['max']) # Store the lag, if it is the longest yet
+
+async def measure(func, iterations, percentile):
+    """Benchmark a function. It is called with the index of each iteration, and each call is timed. If
+    it is a coroutine function, it is awaited, and the event loop is watched while it runs. One more call
+    is made afterwards with tracemalloc running, for the peak memory, since tracing slows everything
+    down too much to time at the same time."""
+    coroutine = asyncio.iscoroutinefunction(func) # Check if the function has to be awaited
+    blocked = {'max': 0.0} # The longest the event loop was blocked
+    watcher = asyncio.create_task(watch_loop(blocked)) if coroutine else None # Only watch the event loop for coroutines, since anything else blocks it by definition
+    await asyncio.sleep(0) # Let the watcher start
+
+    times = [] # The time each call took
+    start = time.perf_counter() # Get the time the benchmark started at
+    for index in range(iterations): # Call the function for each iteration
+        before = time.perf_counter() # Get the time before the call
+        result = func(index) # Call the function
+        if coroutine: # Check if the function has to be awaited
+            await result # If so, await it
+        times.append(time.perf_counter() - before) # Store how long the call took
+    total = time.perf_counter() - start # Get how long the benchmark took
+
+    if watcher: # Check if the event loop was watched
+        watcher.cancel() # If so, stop watching it
+
+    tracemalloc.start() # Start tracing memory
+    try: # Make sure tracing is stopped
+        result = func(iterations) # Call the function one more time
+        if coroutine: # Check if the function has to be awaited
+            await result # If so, await it
+        peak = tracemalloc.get_traced_memory()[1] # Get the peak memory of the call
+    finally:
+        tracemalloc.stop() # Stop tracing memory
+
+    return { # Return the results
+        'iterations': iterations,
+        'throughput': iterations / total,
+        'p50': percentile(times, 50),
+        'p99': percentile(times, 99),
+        'peak_memory': peak,
+        'blocked': blocked['max'] if coroutine else None,
+    }
+
+async def run_case(bot, server_dir, names, iterations):
+    """Run every benchmark against a single server directory, and return a dictionary of benchmark
+    names to their results. Half of the servers are registered as running, and the other half are
+    split between the start_server and run benchmarks, since each server can only be started once."""
+    running, free = names[1::2], names[0::2] # Register every other server as running
+    starts, runs = free[:len(free) // 2], free[len(free) // 2:] # Split the other servers between the start_server and run benchmarks
+    table = FakeProcessTable(len(running)) # Create a fake process for every running server
+    table.register(bot.registry, running) # Register the servers as running
+
+    scans = max(5, min(iterations, 20000 // len(names))) # Scanning every server directory is slow for big trees, so do it less often
+    ctx = support.StubContext(keep=False) # The context to run commands in. Messages are only counted, so memory use doesn't grow with every iteration
+    results = {} # The results of each benchmark
+
+    def cold_scan(index):
+        """Scan the server directory with an empty catalog."""
+        bot.catalog = bot.ServerCatalog(server_dir, 0) # Start over with an empty catalog
+        bot.get_server_dirs() # Scan every server directory
+
+    async def start(index):
+        """Start a server that isn't running."""
+        await bot.start_server(starts[index]) # Start the server
+
+    async def start_running(index):
+        """Try to start a server that is already running."""
+        try: # Try to start the server
+            await bot.start_server(running[index % len(running)]) # Start the server
+        except RuntimeError: # Catch that the server is already running
+            pass # That is the point
+
+    async def run_list(index):
+        """Run the run command without any servers, to list them."""
+        await bot.run.callback(ctx) # Run the command
+
+    async def run_start(index):
+        """Run the run command with a server that isn't running, one that is and one that doesn't exist."""
+        await bot.run.callback(ctx, runs[index], running[index % len(running)], 'missing') # Run the command
+
+    async def helpme(index):
+        """Run the helpme command."""
+        await bot.help.callback(ctx) # Run the command
+
+    with table.installed(bot): # Make the bot see the fake processes
+        results['get_server_dirs (cold)'] = await measure(cold_scan, scans, bot.percentile)
+        results['get_server_dirs (warm)'] = await measure(lambda index: bot.get_server_dirs(), scans, bot.percentile)
+        results['get_server_list (warm)'] = await measure(lambda index: bot.get_server_list(), scans, bot.percentile)
+        results['start_server'] = await measure(start, min(iterations, len(starts) - 1), bot.percentile)
+        results['start_server (running)'] = await measure(start_running, iterations, bot.percentile)
+        results['run (list)'] = await measure(run_list, scans, bot.percentile)
+        results['run (start)'] = await measure(run_start, min(iterations, len(runs) - 1), bot.percentile)
+        results['helpme'] = await measure(helpme, iterations, bot.percentile)
+
+        await asyncio.gather(*(server.task for server in list(bot.supervisor.servers.values()))) # Wait for the started servers to exit
+
+    return results # Return the results
+
+def run_benchmarks(sizes, iterations):
+    """Run the benchmarks for every size of server directory, with and without metadata files, and
+    return a dictionary of result keys to their results."""
+    results = {} # The results of every benchmark
+    for count in sizes: # Loop through each size
+        for metadata in (False, True): # Benchmark with and without metadata files
+            with tempfile.TemporaryDirectory() as root: # Create a directory for the tree and the bot
+                server_dir = path.join(root, 'servers') # Construct a path to the server directory
+                work_dir = path.join(root, 'bot') # Construct a path to the directory of the bot
+                os.mkdir(server_dir)
+                os.mkdir(work_dir)
+
+                print(f'Benchmarking {count} servers {"with" if metadata else "without"} metadata...', file=sys.stderr) # Print the progress
+                names = make_tree(server_dir, count, metadata) # Generate the servers
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull): # Hide the console output of the bot
+                    bot = support.load_bot_copy(work_dir, server_dir, 'bench_bot', token='benchmark', catalog_refresh_interval=0, memory_reserve=0) # Load the bot. The catalog is never throttled, so every call pays for checking the filesystem
+                    try: # Make sure the worker pool of the bot is shut down
+                        case = asyncio.run(run_case(bot, server_dir, names, iterations)) # Run the benchmarks
+                    finally:
+                        bot.executor.shutdown() # Shut down the worker pool
+
+            for name, result in case.items(): # Loop through each result
+                results[f'{name} [{count} servers, {"metadata" if metadata else "no metadata"}]'] = result # Store it under a key that says what it measured
+
+    return results # Return the results
+
+def best_of(runs):
+    """Merge the results of several runs, keeping the best value of each field: the highest throughput
+    and the lowest of everything else. Other programs on the machine only ever make results worse, so
+    the best of a few runs is much more stable than any single one."""
+    results = {} # The merged results
+    for key in runs[0]: # Loop through each result
+        values = [run[key] for run in runs] # Get the result from every run
+        results[key] = {field: (max if field == 'throughput' else min)(value[field] for value in values) if values[0][field] is not None else None for field in values[0]} # Keep the best value of each field
+
+    return results # Return the merged results
+
+def compare(results, baseline, tolerance):
+    """Compare results to a baseline. A result has regressed if its latency, peak memory or event loop
+    blocking grew, or its throughput shrank, by more than the tolerance. Differences smaller than the
+    slack are ignored, since they are mostly noise, and so is the 99th percentile unless both the
+    result and the baseline come from at least P99_MIN_ITERATIONS samples. A list of descriptions of
+    every regression is returned."""
+    regressions = [] # The descriptions of the regressions
+    for key, result in results.items(): # Loop through each result
+        base = baseline.get(key) # Get the baseline of the result
+        if not base: # Check if there is no baseline for the result
+            continue # If so, there is nothing to compare to
+
+        current = dict(result, mean=1 / result['throughput']) # Compare the throughput as the mean latency, so it can be treated like the others
+        previous = dict(base, mean=1 / base['throughput'])
+        for field, slack in SLACK.items(): # Loop through each field that is compared
+            if current[field] is None or previous.get(field) is None: # Check if the field wasn't measured
+                continue # If so, skip it
+            if field == 'p99' and min(current['iterations'], previous['iterations']) < P99_MIN_ITERATIONS: # Check if there are too few samples for the 99th percentile to mean much
+                continue # If so, skip it
+
+            if current[field] > previous[field] * (1 + tolerance) and current[field] - previous[field] > slack: # Check if the field got worse by too much
+                regressions.append(f'{key}: {field} went from {previous[field]:.6g} to {current[field]:.6g}') # If so, describe the regression
+
+    return regressions # Return the regressions
+
+def print_report(results):
+    """Print a table of the results."""
+    width = max(len(key) for key in results) # Get the length of the longest key
+    print(f'{"benchmark":<{width}}  {"ops/s":>10}  {"p50 ms":>9}  {"p99 ms":>9}  {"peak KiB":>9}  {"blocked ms":>10}') # Print the header
+    for key, result in results.items(): # Loop through each result
+        blocked = '-' if result['blocked'] is None else f'{result["blocked"] * 1000:.2f}' # Format the event loop blocking, if it was measured
+        print(f'{key:<{width}}  {result["throughput"]:>10.1f}  {result["p50"] * 1000:>9.3f}  {result["p99"] * 1000:>9.3f}  {result["peak_memory"] / 1024:>9.0f}  {blocked:>10}') # Print the result
+
+def main():
+    """Run the benchmarks, print the results, and compare them to the baseline or store them as the new
+    baseline. Exits with an error if anything regressed."""
+    parser = argparse.ArgumentParser(description='Benchmark the command path of the bot against synthetic server directories.') # Create the argument parser
+    parser.add_argument('--sizes', default='10,100,1000,10000', help='comma separated amounts of servers to generate (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=50, help='how many times to run each benchmark (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='how many times to run every benchmark, keeping the best result, at least 3 (default: %(default)s)')
+    parser.add_argument('--baseline', default=path.join(dir_path, 'bench_baseline.json'), help='the baseline file (default: bench_baseline.json)')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='how much worse than the baseline a result can be, as a fraction (default: %(default)s)')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline instead of comparing to it')
+    args = parser.parse_args() # Parse the arguments
+
+    sizes = [int(size) for size in args.sizes.split(',')] # Parse the sizes
+    if min(sizes) < 4: # Check if a tree is too small to split between the benchmarks
+        parser.error('every size has to be at least 4') # If so, exit with an error
+    if args.repeat < MIN_REPEAT: # Check if a single noisy run could decide the results
+        parser.error(f'--repeat has to be at least {MIN_REPEAT} to compare to or store a baseline') # If so, exit with an error
+
+    results = best_of([run_benchmarks(sizes, args.iterations) for _ in range(args.repeat)]) # Run the benchmarks, keeping the best of every run
+    print_report(results) # Print the results
+
+    if args.save: # Check if the results should be stored as the new baseline
+        baseline = {} # The old baseline, whose results are kept for sizes that weren't run
+        if path.exists(args.baseline): # Check if there is an old baseline
+            with open(args.baseline) as file: # If so, open it
+                baseline = json.load(file) # and parse it
+        baseline.update(results) # Replace the results that were run
+        with open(args.baseline, 'w') as file: # Open the baseline file
+            json.dump(baseline, file, indent=2, sort_keys=True) # Store the baseline
+        print(f'Stored the results as the baseline in {args.baseline}') # Print a message to inform of the current status
+        return
+
+    if not path.exists(args.baseline): # Check if there is no baseline
+        print(f'There is no baseline at {args.baseline}. Run with --save to store one.') # If so, there is nothing to compare to
+        return
+
+    with open(args.baseline) as file: # Open the baseline file
+        baseline = json.load(file) # Parse the baseline
+
+    regressions = compare(results, baseline, args.tolerance) # Compare the results to the baseline
+    if regressions: # Check if anything regressed
+        print(f'\n{len(regressions)} regression(s) compared to {args.baseline}:') # If so, print them
+        for regression in regressions:
+            print(f'\t{regression}')
+        sys.exit(1) # and exit with an error
+
+    print(f'\nNo regressions compared to {args.baseline}') # Print a message to inform of the current status
+
+if __name__ == '__main__':
+    main()
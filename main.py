@@ -1,14 +1,34 @@
 # Import
+import asyncio
+import atexit
+import bisect
 import discord
 from discord.ext import commands
 import os
 from os import path
 import threading
+import time
+import collections
 import configparser
+import contextlib
+import functools
+import hmac
+import heapq
+import itertools
+import json
+import logging
+import logging.handlers
+import math
 import traceback
 import psutil
+from queue import Full, Queue
+import re
+import socket
 import subprocess
+import struct
+import sys
 from shlex import quote, split
+from concurrent.futures import ThreadPoolExecutor
 
 dir_path = path.dirname(path.realpath(__file__)) # Get the full path of the directory that this file is contained in
 
@@ -20,22 +40,27 @@ if not path.exists(config_file) or not path.isfile(config_file): # Check to make
 config = configparser.ConfigParser() # Create a new config parser
 config.read(config_file) # Read the contents of the config file into the parser
 
-if not config['DEFAULT'] or not config['DEFAULT']['server_dir'] or not config['DEFAULT']['token']: # Check to make sure the necessary information is in the config file
+agent_mode = '--agent' in sys.argv # Whether this node runs as an agent for a bot on another node, instead of as the bot itself
+
+if not config['DEFAULT'] or not config['DEFAULT'].get('server_dir') or not (agent_mode or config['DEFAULT'].get('token')): # Check to make sure the necessary information is in the config file
     print('The config file does not have the necessary information. Make sure there is a "DEFAULT" section, with "server_dir" and "token" in it.') # If not, write a log message...
     quit() # and quit
 
+if agent_mode and not config['DEFAULT'].get('node_secret'): # Check to make sure an agent has a secret, so not just anyone can start servers on it
+    print('An agent needs a "node_secret" in the config file, which has to be the same as the bot\'s.') # If not, write a log message...
+    quit() # and quit
+
 server_dir = config['DEFAULT']['server_dir'] # Get the specified server directory. This should be a directory containing subdirectories, which contain servers
 if not path.exists(server_dir) or not path.isdir(server_dir): # Check to make sure the server directory exists and is an actual directory
     print(f'The directory specified for server_dir({server_dir}) either doesn\'t exist, or isn\'t a directory.') # If not, write a log message...
     quit() # and quit
 
-token = config.get('DEFAULT', 'token') # Get the token
+token = config.get('DEFAULT', 'token', fallback=None) # Get the token. An agent doesn't need one
 
 prefix = config.get('DEFAULT', 'prefix', fallback='.')
 bot_role = config.get('DEfAULT', 'role', fallback='Minecraft OPS')
 
 print(f'Using {server_dir} as the server directory.') # Print a log message to inform about the current status
-server_threads = [] # A list of all of the thread of the running servers
 
 class Help(commands.DefaultHelpCommand): # Define the help command
     """The help command to be used. This overrides the default help command, in order to provide
@@ -73,42 +98,648 @@ class Help(commands.DefaultHelpCommand): # Define the help command
         name, offset by some value."""
         return max(list(len(command.name) for command in commands)) + self.size_offset # This is the shorthand to get the max length of each command name, then add an offset the the result.
 
-class ServerThread(threading.Thread):
-    """A thread to run a server. This is a simple thread implementation, which will run
-    a server start file in another thread, so it doesn't block the current thread."""
-
-    def __init__(self, dir, file):
-        """Initialize the variables. The main objective here is to get the file to actually run.
-        Another product is to call the super initializer with a name, but to my knowledge, that
-        is not too entirely necessary."""
+class Histogram:
+    """A histogram of durations. Each value is counted in the first bucket it fits in, so observing a
+    value is cheap and memory use doesn't grow, at the cost of percentiles only being as precise as the
+    buckets."""
+
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0) # The upper bounds of the buckets, in seconds
+
+    def __init__(self):
+        """Initialize the variables. The histogram starts out empty."""
+        self.counts = [0] * (len(self.buckets) + 1) # The amount of values in each bucket. The last bucket is for values bigger than every bound
+        self.sum = 0.0 # The sum of all of the values
+        self.count = 0 # The amount of values
+
+    def observe(self, value):
+        """Count a value."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1 # Count the value in the first bucket it fits in
+        self.sum += value # Add the value to the sum
+        self.count += 1 # Count the value
+
+    def quantile(self, fraction):
+        """Estimate a quantile, as the upper bound of the bucket it falls in. If there are no values,
+        None is returned, and if it falls in the last bucket, infinity is returned."""
+        if not self.count: # Check if there are no values
+            return None # If so, there is no quantile
+
+        rank = fraction * self.count # Figure out how many values are below the quantile
+        total = 0 # The amount of values in the buckets so far
+        for bound, count in zip(self.buckets, self.counts): # Loop through each bucket
+            total += count # Add the values in the bucket
+            if total >= rank: # Check if the quantile is in this bucket
+                return bound # If so, return its upper bound
+
+        return math.inf # Otherwise, the quantile is bigger than every bound
+
+class Metrics:
+    """The metrics of the bot. Durations are counted in histograms and current values are kept in
+    gauges, both identified by a name and optionally labels. Everything is kept in memory and can be
+    rendered in the Prometheus text format. Metrics can be recorded from any thread."""
+
+    def __init__(self):
+        """Initialize the variables. There are no metrics until something is recorded."""
+        self.histograms = {} # A dictionary of names and labels to histograms
+        self.gauges = {} # A dictionary of names and labels to values
+        self.lock = threading.Lock() # A lock, because metrics are recorded from worker threads too
+
+    def observe(self, name, value, **labels):
+        """Count a duration, in seconds, in a histogram."""
+        key = (name, tuple(sorted(labels.items()))) # Build the key of the histogram
+        with self.lock: # Make sure nothing else records metrics at the same time
+            histogram = self.histograms.get(key) # Look up the histogram
+            if not histogram: # Check if the histogram doesn't exist yet
+                histogram = self.histograms[key] = Histogram() # If so, create it
+            histogram.observe(value) # Count the value
+
+    def set(self, name, value, **labels):
+        """Set the value of a gauge."""
+        with self.lock: # Make sure nothing else records metrics at the same time
+            self.gauges[(name, tuple(sorted(labels.items())))] = value # Set the value
+
+    def clear(self, name):
+        """Remove every gauge with a name, whatever its labels. This is used for gauges about things
+        that can go away, like servers that have stopped."""
+        with self.lock: # Make sure nothing else records metrics at the same time
+            for key in [key for key in self.gauges if key[0] == name]: # Loop through the gauges with the name
+                del self.gauges[key] # Remove the gauge
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Time a block of code, and count the duration in a histogram. This works the same in
+        synchronous and asynchronous code."""
+        start = time.perf_counter() # Get the time the block starts at
+        try: # Run the block
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels) # Count how long the block took
+
+    def render(self):
+        """Render every metric in the Prometheus text format."""
+        def format_labels(labels, extra=()):
+            """Format labels, like {server="a"}."""
+            labels = tuple(labels) + tuple(extra) # Put any extra labels after the others
+            if not labels: # Check if there are no labels
+                return '' # If so, there is nothing to format
+            return '{' + ','.join('{0}="{1}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels) + '}' # Format each label, escaping the value
+
+        lines = [] # The lines of the rendered metrics
+        with self.lock: # Make sure nothing records metrics while they are rendered
+            typed = set() # The names that have had their type written
+            for (name, labels), histogram in sorted(self.histograms.items()): # Loop through each histogram, in order
+                if name not in typed: # Check if the type of the histogram hasn't been written yet
+                    lines.append(f'# TYPE {name} histogram') # If so, write it
+                    typed.add(name) # and remember that it has been written
+
+                total = 0 # The amount of values in the buckets so far. Prometheus buckets are cumulative
+                for bound, count in zip(histogram.buckets + (math.inf,), histogram.counts): # Loop through each bucket
+                    total += count # Add the values in the bucket
+                    lines.append(f'{name}_bucket{format_labels(labels, [("le", "+Inf" if bound == math.inf else bound)])} {total}') # Write the bucket
+                lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}') # Write the sum
+                lines.append(f'{name}_count{format_labels(labels)} {histogram.count}') # Write the count
+
+            for (name, labels), value in sorted(self.gauges.items()): # Loop through each gauge, in order
+                if name not in typed: # Check if the type of the gauge hasn't been written yet
+                    lines.append(f'# TYPE {name} gauge') # If so, write it
+                    typed.add(name) # and remember that it has been written
+                lines.append(f'{name}{format_labels(labels)} {value}') # Write the gauge
+
+        return '\n'.join(lines) + '\n' # Return the rendered metrics
+
+metrics = Metrics() # Create the metrics
+
+class ProcessRegistry:
+    """A registry of the processes of running servers. Whenever a server is launched, the PID of its
+    process is stored here along with the time the process was created, and the registry is saved to
+    a file so that it survives the bot being restarted. Checking if a server is running is then just a
+    lookup in the registry and a check that the process is still alive, instead of going through
+    every process on the machine. The creation time is checked along with the PID, so that a new
+    process that happens to reuse the PID of a server that has stopped isn't mistaken for it."""
+
+    def __init__(self, file):
+        """Initialize the variables. The registry starts out empty, and should be filled by calling
+        load."""
+        self.file = file # Store the path of the file the registry is saved to
+        self.processes = {} # A dictionary of server names to a dictionary with the pid and create_time of the server's process
+        self.lock = threading.Lock() # A lock, because processes are registered and unregistered from worker threads
+
+    def load(self):
+        """Load the registry from its file. Any process in the file that is no longer alive is
+        dropped, and the cleaned up registry is saved again."""
+        with self.lock: # Make sure nothing else modifies the registry while it is loaded
+            try: # Try to read the registry file
+                with open(self.file) as file: # Open the registry file
+                    processes = json.load(file) # Parse the contents of the registry file
+            except FileNotFoundError: # Catch if there is no registry file yet
+                processes = {} # If so, there are no processes to load
+            except (OSError, ValueError): # Catch if the registry file can't be read or is corrupt
+                print(f'Could not read the process registry {self.file}. Ignoring.') # If so, print a message to the console...
+                traceback.print_exc() # print the full error...
+                processes = {} # and start with an empty registry
+
+            self.processes = {name: info for name, info in processes.items() if self.alive(info)} # Only keep the processes that are still alive
+            self.save() # Save the cleaned up registry
+
+        for name, info in self.processes.items(): # Loop through each of the servers that are still running
+            print(f'Server "{name}" is still running as PID {info["pid"]}') # Print a message to the console to inform of the current status
+
+    def save(self):
+        """Save the registry to its file. The registry is written to a temporary file first, which then
+        replaces the registry file, so that the file is never left half written. This should only be
+        called while holding the lock."""
+        tmp_file = f'{self.file}.tmp' # Construct a path to the temporary file
+        with open(tmp_file, 'w') as file: # Open the temporary file
+            json.dump(self.processes, file) # Write the registry to the temporary file
+        os.replace(tmp_file, self.file) # Replace the registry file with the temporary file
+
+    def alive(self, info):
+        """Check if a registered process is still alive. The PID has to exist, and the process with
+        that PID has to have been created at the same time as the registered one."""
+        if not psutil.pid_exists(info['pid']): # Check if there is a process with the PID
+            return False # If not, the process is not alive
+
+        try: # Try to get the creation time of the process
+            return psutil.Process(info['pid']).create_time() == info['create_time'] # Check if it is the same process that was registered
+        except psutil.Error: # Catch if the process exited in the meantime, or can't be accessed
+            return False # If so, treat the process as not alive
+
+    def register(self, name, pid):
+        """Register the process of a server. This should be called as soon as the process is created.
+        If the process has already exited by then, there is nothing to register."""
+        try: # Try to get the creation time of the process
+            create_time = psutil.Process(pid).create_time() # Get the creation time of the process
+        except psutil.NoSuchProcess: # Catch if the process has already exited
+            return # If so, it isn't running, so it shouldn't be registered
+
+        with self.lock: # Make sure nothing else modifies the registry at the same time
+            self.processes[name] = {'pid': pid, 'create_time': create_time} # Store the PID and creation time of the process
+            self.save() # Save the registry
+
+    def unregister(self, name, pid):
+        """Unregister the process of a server. This should be called when the process exits. If the
+        server has been registered with a different process in the meantime, nothing happens."""
+        with self.lock: # Make sure nothing else modifies the registry at the same time
+            info = self.processes.get(name) # Get the registered process of the server
+            if info and info['pid'] == pid: # Check if the registered process is the one that exited
+                del self.processes[name] # If so, remove it from the registry...
+                self.save() # and save the registry
+
+    def snapshot(self):
+        """Get a copy of the registered processes. Worker threads register and unregister processes at
+        any time, so the registry should only be looked through using a copy."""
+        with self.lock: # Make sure nothing else modifies the registry while it is copied
+            return dict(self.processes) # Copy the registered processes
+
+    def get_pid(self, name):
+        """Get the PID of a running server. If the server isn't registered, or its process is no longer
+        alive, None is returned."""
+        with self.lock: # Make sure nothing else modifies the registry at the same time
+            info = self.processes.get(name) # Get the registered process of the server
+            if not info: # Check if the server isn't registered
+                return None # If so, it isn't running
+
+            if not self.alive(info): # Check if the process has died without being unregistered
+                del self.processes[name] # If so, remove it from the registry...
+                self.save() # save the registry...
+                return None # and report that it isn't running
+
+            return info['pid'] # Return the PID of the running server
+
+registry = ProcessRegistry(config.get('DEFAULT', 'pid_file', fallback=path.join(dir_path, 'pids.json'))) # Create the process registry
+registry.load() # Rebuild the registry from the last time the bot was running
+
+PRIORITIES = { # The process priorities that can be configured, and what they mean on Windows and everywhere else
+    'low': (psutil.BELOW_NORMAL_PRIORITY_CLASS, 10) if os.name == 'nt' else (None, 10),
+    'normal': (psutil.NORMAL_PRIORITY_CLASS, 0) if os.name == 'nt' else (None, 0),
+    'high': (psutil.HIGH_PRIORITY_CLASS, -5) if os.name == 'nt' else (None, -5),
+}
+
+DETACHED = {'creationflags': subprocess.CREATE_NEW_CONSOLE} if os.name == 'nt' else {'start_new_session': True} # How to run servers apart from the bot, so that pressing Ctrl+C in or closing the console of the bot doesn't stop them too
+
+class ConsoleLogWriter(logging.Handler):
+    """Writes console lines to the log files they belong to. Each line carries the file handler of its
+    console log, so a single listener thread can write the lines of every server."""
+
+    def emit(self, record):
+        """Write a line to its log file."""
+        record.file_handler.handle(record) # Hand the line to the file handler of its console log
+
+class ConsoleLogListener(logging.handlers.QueueListener):
+    """The thread writing console lines to log files. This is the same as the default listener, except
+    that it waits for room in the queue to tell the thread to stop, instead of failing if it is full."""
+
+    def enqueue_sentinel(self):
+        """Tell the thread to stop once it has written the lines before this."""
+        self.queue.put(None) # Wait for room in the queue, and queue the signal to stop
+
+log_queue = Queue(config.getint('DEFAULT', 'log_queue_lines', fallback=10000)) # The console lines waiting to be written to log files. This is bounded, so a stalled disk can't make it grow without limit
+log_listener = None # The thread writing console lines to log files. This is started once the first log file is set up
+
+def start_log_listener():
+    """Start the thread writing console lines to log files, if it isn't running yet. Writing and
+    rotating log files touches the disk, so it is done on this thread instead of on the event loop."""
+    global log_listener
+    if log_listener: # Check if the thread is already running
+        return # If so, there is nothing to do
+
+    log_listener = ConsoleLogListener(log_queue, ConsoleLogWriter()) # Create the thread
+    log_listener.start() # Start it
+    atexit.register(log_listener.stop) # Make sure the lines that are still waiting are written before exiting
+
+class ConsoleLog:
+    """The captured console output of a server. The most recent lines are kept in a ring buffer of a
+    fixed size, so memory use stays flat no matter how much a server writes. Optionally, every line is
+    also written to a log file, which is rotated once it gets too big. Lines are written to the log file
+    by a separate thread, so the event loop never waits for the disk. If that thread falls too far
+    behind, lines are left out of the log file and counted instead, and the log file says how many
+    were left out once there is room again."""
+
+    max_line = 1000 # The maximum length of a line. Longer lines are cut off, so a single line can't take up too much memory
+
+    def __init__(self, name, size=1000, file=None, max_bytes=1048576, backups=3):
+        """Initialize the variables. If a file is given, a rotating log file is set up, but it isn't
+        created until the first line is written."""
+        self.name = name # Store the name of the server
+        self.lines = collections.deque(maxlen=size) # The ring buffer of lines. Appending to a full buffer drops the oldest line
+        self.handler = None # The handler writing lines to the log file, if there is one
+        self.dropped = 0 # The amount of lines left out of the log file since the last one that was written
+        self.total_dropped = 0 # The amount of lines left out of the log file in total
+        if file: # Check if the output should be written to a file
+            self.handler = logging.handlers.RotatingFileHandler(file, maxBytes=max_bytes, backupCount=backups, encoding='utf-8', delay=True) # If so, create a handler that rotates the file when it gets too big
+            start_log_listener() # Make sure there is a thread to write the lines
+
+    def append(self, line):
+        """Add a line of output. The line is cut off if it is too long, added to the ring buffer, and
+        queued to be written to the log file if there is one."""
+        line = line[:self.max_line] # Cut off the line if it is too long
+        self.lines.append(line) # Add the line to the ring buffer
+
+        if self.handler: # Check if there is a log file
+            if self.dropped and self.queue_line(f'[{self.dropped} lines were left out of the log file]'): # Check if lines were left out of the log file, and there is room again to say so
+                self.dropped = 0 # If so, start counting again
+            if self.dropped or not self.queue_line(line): # Check if lines are still being left out, or there is no room for this one
+                self.dropped += 1 # If so, count the line instead...
+                self.total_dropped += 1
+                metrics.set('console_log_dropped_lines', self.total_dropped, server=self.name) # and record how many lines were left out in total
+
+    def queue_line(self, line):
+        """Queue a line to be written to the log file. This returns whether there was room for it."""
+        try: # Try to queue the line
+            log_queue.put_nowait(logging.makeLogRecord({'name': self.name, 'msg': line, 'file_handler': self.handler})) # Queue the line
+        except Full: # Catch if the thread writing the log files is too far behind
+            return False # If so, the line can't be queued
+        return True # The line was queued
+
+    def tail(self, amount):
+        """Get the last lines of output, oldest first. Only the requested lines are copied out of the
+        ring buffer, by walking it backwards from the end."""
+        lines = list(itertools.islice(reversed(self.lines), amount)) # Get the last lines, newest first
+        lines.reverse() # Put them back in order
+        return lines # Return the lines
+
+READY_PATTERN = re.compile(r'Done \((\d+(?:[.,]\d+)?)s\)!') # The line a Minecraft server prints once it is ready for players
+
+def parse_address(ip):
+    """Parse the address of a server from its ip metadata. This can be a host, or a host and a port
+    separated by a colon. If there is no port, the default Minecraft port is used. If there is no
+    address at all, or it can't be parsed, None is returned."""
+    if not ip: # Check if there is no address
+        return None # If so, there is nothing to parse
+
+    ip = ip.strip() # Remove any surrounding whitespace
+    if ip.startswith('['): # Check if the host is an IPv6 address in brackets, like [::1]:25565
+        host, _, port = ip[1:].partition(']') # If so, split the host off at the closing bracket
+        port = port.lstrip(':') # and remove the colon before the port
+    elif ip.count(':') == 1: # Check if there is a port after the host
+        host, _, port = ip.partition(':') # If so, split the host and the port
+    else:
+        host, port = ip, None # Otherwise, the whole thing is the host
+
+    try: # Try to parse the port
+        return host, int(port) if port else 25565 # Return the host and the port, or the default port if there isn't one
+    except ValueError: # Catch if the port isn't a number
+        return None # If so, the address can't be used
+
+def percentile(values, percent):
+    """Get a percentile of a list of values, using the nearest rank. The values don't have to be
+    sorted. If there are no values, None is returned."""
+    if not values: # Check if there are no values
+        return None # If so, there is no percentile
+
+    values = sorted(values) # Sort the values
+    return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)] # Return the value at the nearest rank
+
+def has_shebang(file):
+    """Check if a file starts with a shebang, which says what to run it with. A file that can't be read
+    doesn't have one."""
+    try: # Try to read the start of the file
+        with open(file, 'rb') as f: # Open the file
+            return f.read(2) == b'#!' # Check if it starts with a shebang
+    except OSError: # Catch if the file can't be read
+        return False # If so, it doesn't have a shebang
+
+class SupervisedServer:
+    """A server that is being supervised. This holds the process of the server, along with what is
+    needed to start it again if it crashes."""
+
+    def __init__(self, name, dir, file, address=None):
+        """Initialize the variables. The process is None until the server is spawned. The address is
+        a tuple of a host and a port that the server accepts connections on once it is ready, or None
+        if it isn't known."""
+        self.name = name # Store the name of the server
         self.dir = dir # Store the directory to run the file in
-        self.file = file # Store the file to run in an instance variable
-
-        super().__init__(name=f'server-{file}') # Call the super initializer with a name
-
-    def run(self):
-        """Run the thread. This is the actual logic of the thread. It is as simple as just running the
-        file as a command."""
-        print(f'Running server {self.file} in {self.dir}') # Write a simple debug message to the console
-
-        try: # Try to run the file
-            subprocess.run(f'start "Server" /D "{self.dir}" /MIN /HIGH "{self.file}"', shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) # Run the file
-        except Exception as ex: # Catch any exceptions that may occur when running the file
-            print(f'Error running {self.file}:\n\n') # Print a console message to help identify issues
+        self.file = file # Store the file to run
+        self.address = address # Store the address the server listens on
+        self.process = None # The process of the server
+        self.started = None # The time the process was last spawned at, used to tell crashes on startup from crashes later on
+        self.failures = 0 # The number of times in a row the server has crashed shortly after being started
+        self.stopping = False # Whether the server is meant to stop. If it is, it won't be restarted when it exits
+        self.task = None # The task that waits for the server to exit
+        self.reader = None # The task that reads the console output of the server
+        self.probe = None # The task that checks if the server accepts connections, if its address is known
+        self.ready = asyncio.Event() # Set once the server is ready for players. It is cleared each time the server is spawned, so anything waiting for it sees a restarted server become ready
+        self.startup_time = None # How long the server took to become ready, in seconds
+
+class Supervisor:
+    """The supervisor of all of the servers that the bot starts. Start files are run directly,
+    without a shell, and every server is watched from the event loop instead of from a thread of its
+    own, so supervising many servers doesn't cost many idle threads. When a server exits, it is
+    removed from the process registry, and if it crashed, it can be restarted after a delay that
+    doubles with every crash in a row."""
+
+    def __init__(self, priority='high', restart=False, backoff=5.0, max_backoff=300.0, stable_time=600.0, log_size=1000, log_dir=None, log_max_bytes=1048576, log_backups=3, ready_timeout=600.0, startup_samples=100):
+        """Initialize the variables. The options control the priority of the servers, whether and how
+        quickly crashed servers are restarted, how their console output is kept, and how long to wait
+        for them to become ready."""
+        self.priority = priority # The priority to run the servers at. This is a name from PRIORITIES, or a niceness
+        self.restart = restart # Whether to restart servers that crash
+        self.backoff = backoff # The delay before restarting a server the first time it crashes, in seconds
+        self.max_backoff = max_backoff # The maximum delay before restarting a server, in seconds
+        self.stable_time = stable_time # How long a server has to run before a crash no longer counts as crashing in a row, in seconds
+        self.servers = {} # A dictionary of server names to the servers being supervised
+        self.log_size = log_size # The amount of lines of console output to keep in memory for each server
+        self.log_dir = log_dir # The directory to write console output to, or None to only keep it in memory
+        self.log_max_bytes = log_max_bytes # The size a log file can grow to before it is rotated
+        self.log_backups = log_backups # The amount of rotated log files to keep
+        self.logs = {} # A dictionary of server names to their console output. This is kept after a server exits, so it can be checked for why it stopped
+        self.ready_timeout = ready_timeout # How long to wait for a server to become ready, in seconds
+        self.startup_samples = startup_samples # The amount of startup times to keep for each server
+        self.startup_times = {} # A dictionary of server names to the most recent times they took to become ready, in seconds
+
+    def get_log(self, name):
+        """Get the console output of a server, creating it if the server doesn't have any yet."""
+        log = self.logs.get(name) # Look up the console output of the server
+        if not log: # Check if the server doesn't have any console output yet
+            file = None # The path to the log file. This is None if there shouldn't be one
+            if self.log_dir: # Check if console output should be written to files
+                os.makedirs(self.log_dir, exist_ok=True) # If so, make sure the directory exists...
+                file = path.join(self.log_dir, f'{name}.log') # and construct a path to the log file
+            log = self.logs[name] = ConsoleLog(name, self.log_size, file, self.log_max_bytes, self.log_backups) # Create the console output
+        return log # Return the console output
+
+    async def read_output(self, server, process, log):
+        """Read the console output of a server line by line into its console log, until the server
+        closes its output. Once the server prints the line saying it is done starting, it is marked
+        as ready."""
+        while True: # Keep reading until there is no more output
+            try: # Try to read a line
+                line = await process.stdout.readline() # Read a line of output
+            except ValueError: # Catch if the line is too long to read at once. The part that was read is discarded
+                continue # Continue with whatever comes next
+
+            if not line: # Check if the output was closed
+                break # If so, stop reading
+
+            line = line.decode('utf-8', errors='replace').rstrip('\r\n') # Decode the line
+            log.append(line) # Add the line to the console output
+
+            if not server.ready.is_set() and READY_PATTERN.search(line): # Check if this is the line saying the server is ready
+                self.mark_ready(server) # If so, mark the server as ready
+
+    async def probe_port(self, server, ready):
+        """Check if a server is accepting connections on its address. This tries to connect every
+        second or so, until the server is ready, exits, or takes longer than ready_timeout. As soon as a
+        connection is accepted, the server is marked as ready."""
+        process = server.process # Get the process of the server, to tell if it exits
+        deadline = time.monotonic() + self.ready_timeout # Figure out when to give up
+        while not ready.is_set() and process.returncode is None and time.monotonic() < deadline: # Keep trying until the server is ready, has exited, or it is time to give up
+            try: # Try to connect to the server
+                _, writer = await asyncio.wait_for(asyncio.open_connection(*server.address), timeout=2) # Connect to the server
+            except (OSError, asyncio.TimeoutError): # Catch if the server isn't accepting connections yet
+                await asyncio.sleep(1) # If so, wait a bit before trying again
+                continue # and try again
+
+            writer.close() # Close the connection again
+            if server.process is process: # Check if the server hasn't been restarted in the meantime
+                self.mark_ready(server) # If so, mark the server as ready
+
+    def mark_ready(self, server):
+        """Mark a server as ready. The time it took to become ready is recorded in its startup times,
+        and anything waiting for it to be ready is woken up."""
+        if server.ready.is_set(): # Check if the server is already marked as ready
+            return # If so, there is nothing to do
+
+        server.startup_time = time.monotonic() - server.started # Figure out how long the server took to become ready
+        times = self.startup_times.setdefault(server.name, collections.deque(maxlen=self.startup_samples)) # Get the startup times of the server, creating them if there aren't any yet
+        times.append(server.startup_time) # Record the startup time
+        server.ready.set() # Wake up anything waiting for the server to be ready
+
+        print(f'Server "{server.name}" is ready after {server.startup_time:.1f}s') # Print a message to the console to inform of the current status
+
+    async def wait_ready(self, name):
+        """Wait for a server to become ready, and return how long it took, in seconds. If the server
+        exits before it is ready, a RuntimeError is raised, and if it takes longer than ready_timeout,
+        an asyncio.TimeoutError is raised."""
+        server = self.servers.get(name) # Look up the server
+        if not server: # Check if the server isn't supervised
+            raise RuntimeError('The server is not running') # If so, it will never be ready
+
+        ready = asyncio.ensure_future(server.ready.wait()) # Wait for the server to be ready
+        exited = asyncio.ensure_future(server.task) if server.task else asyncio.ensure_future(server.process.wait()) # Wait for the server to exit for good
+        try: # Make sure neither wait is left running
+            done, _ = await asyncio.wait((ready, exited), timeout=self.ready_timeout, return_when=asyncio.FIRST_COMPLETED) # Wait for whichever happens first
+        finally:
+            ready.cancel() # Stop waiting for the server to be ready
+            if exited is not server.task: # Check if the wait for the server to exit isn't the server's own task
+                exited.cancel() # If so, stop waiting for the server to exit
+
+        if ready in done: # Check if the server became ready
+            return server.startup_time # If so, return how long it took
+        if exited in done: # Check if the server exited
+            raise RuntimeError('The server stopped before it was ready') # If so, raise a runtime error
+
+        raise asyncio.TimeoutError('The server did not become ready in time') # Otherwise, it took too long
+
+    def get_command(self, file):
+        """Get the command to run a start file. Batch files are run by the command interpreter, and
+        shell scripts are run themselves if they are executable and start with a shebang, so that
+        the shebang picks the shell, or by sh otherwise. Either way, they are run directly rather than through a shell
+        command line, so that the file name is never interpreted."""
+        if file.endswith('.bat'): # Check if the start file is a batch file
+            return [os.environ.get('COMSPEC', 'cmd.exe'), '/c', file] # If so, run it with the command interpreter
+        if file.endswith('.sh') and not (os.access(file, os.X_OK) and has_shebang(file)): # Check if the start file is a shell script that can't be run itself
+            return ['/bin/sh', file] # If so, run it with sh
+
+        return [file] # Otherwise, run the file itself
+
+    def set_priority(self, pid):
+        """Set the priority of a server's process. Failing to set the priority, for example because
+        raising it requires administrator rights, is logged but doesn't stop the server."""
+        try: # Try to set the priority
+            if self.priority in PRIORITIES: # Check if the priority is a named priority
+                priority_class, niceness = PRIORITIES[self.priority] # Get what the priority means
+                psutil.Process(pid).nice(niceness if priority_class is None else priority_class) # Set the priority class on Windows, or the niceness everywhere else
+            else:
+                psutil.Process(pid).nice(int(self.priority)) # Otherwise, the priority is a niceness
+        except (psutil.Error, ValueError): # Catch if the priority can't be set
+            print(f'Could not set the priority of PID {pid} to {self.priority}') # If so, print a message to the console
+
+    async def spawn(self, server):
+        """Spawn the process of a server, set its priority and register it in the process registry. The
+        console output of the server is read into its console log. The server gets a console or session
+        of its own, so it keeps running when the bot is stopped, and can be found again through the
+        process registry. Its console output is only captured while the bot is running, though."""
+        print(f'Running server {server.file} in {server.dir}') # Write a simple debug message to the console
+
+        with metrics.timer('process_launch_seconds'): # Time launching the process
+            server.process = await asyncio.create_subprocess_exec(*self.get_command(server.file), cwd=server.dir, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **DETACHED) # Run the file apart from the bot, capturing its output
+        server.started = time.monotonic() # Store the time the server was started at
+        server.ready.clear() # The server isn't ready yet. The same event is reused, so anything already waiting for it keeps waiting for the restarted server
+        server.reader = asyncio.create_task(self.read_output(server, server.process, self.get_log(server.name))) # Start reading the output of the server
+        if server.address: # Check if the address of the server is known
+            server.probe = asyncio.create_task(self.probe_port(server, server.ready)) # If so, start checking if it accepts connections
+        self.set_priority(server.process.pid) # Set the priority of the server
+        await run_blocking(registry.register, server.name, server.process.pid) # Register the process of the server
+
+    async def start(self, name, dir, file, address=None):
+        """Start a server. The server is spawned, and a task is created to watch it until it exits for
+        good. If the server can't be spawned, the exception is passed on to the caller."""
+        server = SupervisedServer(name, dir, file, address) # Create the server
+        await self.spawn(server) # Spawn the server. This raises if the file couldn't be run
+
+        self.servers[name] = server # Add the server to the supervised servers
+        server.task = asyncio.create_task(self.watch(server)) # Start watching the server
+
+    async def watch(self, server):
+        """Watch a server. This waits for the server to exit, and removes it from the process registry
+        when it does. If it crashed and restarting is enabled, it is restarted after a delay. The delay
+        doubles for each crash in a row, up to max_backoff, and a server that has run for at least
+        stable_time before crashing starts over with the shortest delay."""
+        try: # Try to watch the server
+            while True: # Keep watching until the server exits for good
+                code = await server.process.wait() # Wait for the server to exit
+                print(f'Server {server.file} exited with code {code}') # Write a simple debug message to the console
+                await run_blocking(registry.unregister, server.name, server.process.pid) # Remove the server from the process registry
+
+                if server.stopping or not self.restart or code == 0: # Check if the server shouldn't be restarted
+                    break # If so, stop watching it
+
+                if time.monotonic() - server.started >= self.stable_time: # Check if the server ran for a while before crashing
+                    server.failures = 0 # If so, this isn't a crash in a row
+                delay = min(self.backoff * 2 ** server.failures, self.max_backoff) # Figure out how long to wait before restarting
+                server.failures += 1 # Count the crash
+
+                print(f'Server "{server.name}" crashed. Restarting in {delay:.0f}s') # Print a message to the console to inform of the current status
+                await asyncio.sleep(delay) # Wait before restarting
+                if server.stopping: # Check if the server was meant to stop in the meantime
+                    break # If so, don't restart it
+
+                await self.spawn(server) # Restart the server
+        except asyncio.CancelledError: # Catch if the task was cancelled
+            raise # Re-raise it, so the task is actually cancelled
+        except Exception: # Catch any exceptions that may occur while watching or restarting the server
+            print(f'Error supervising {server.file}:\n\n') # Print a console message to help identify issues
             traceback.print_exc() # Print the full error
+        finally:
+            if self.servers.get(server.name) is server: # Check if this is still the supervised server with this name
+                del self.servers[server.name] # If so, it is no longer supervised
+
+def use_pidfd_child_watcher():
+    """Make asyncio wait for child processes with pidfds where possible. Before Python 3.12, asyncio
+    waits for each child process with a thread of its own on Linux, which is exactly what the
+    supervisor is meant to avoid. A pidfd lets the event loop itself be told when a child exits.
+    Python 3.12 and later already do this by themselves, and Windows doesn't need it."""
+    if os.name == 'nt' or sys.version_info >= (3, 12) or not hasattr(os, 'pidfd_open'): # Check if the pidfd child watcher isn't needed or isn't available
+        return # If so, keep the default
+
+    try: # Try to open a pidfd, to see if the kernel supports it
+        os.close(os.pidfd_open(os.getpid())) # Open and close a pidfd for this process
+    except OSError: # Catch if the kernel doesn't support pidfds
+        return # If so, keep the default
+
+    watcher = asyncio.PidfdChildWatcher() # Create the pidfd child watcher
+    watcher.attach_loop(asyncio.get_running_loop()) # Attach it to the event loop
+    asyncio.set_child_watcher(watcher) # Use it to wait for child processes
+
+supervisor = Supervisor( # Create the supervisor
+    priority=config.get('DEFAULT', 'priority', fallback='high'),
+    restart=config.getboolean('DEFAULT', 'restart_on_crash', fallback=False),
+    backoff=config.getfloat('DEFAULT', 'restart_backoff', fallback=5.0),
+    max_backoff=config.getfloat('DEFAULT', 'restart_max_backoff', fallback=300.0),
+    log_size=config.getint('DEFAULT', 'log_lines', fallback=1000),
+    log_dir=config.get('DEFAULT', 'log_dir', fallback=None),
+    log_max_bytes=config.getint('DEFAULT', 'log_max_bytes', fallback=1048576),
+    log_backups=config.getint('DEFAULT', 'log_backups', fallback=3),
+    ready_timeout=config.getfloat('DEFAULT', 'ready_timeout', fallback=600.0))
 
 help_command = Help() # Create the help command
 help_command.dm_help = False # Never send help as a dm
 help_command.indent = 4 # Indentation of commands from heading
 help_command.size_offset = 2 # Add a padding offset to the commands
 
-client = commands.Bot(command_prefix = prefix, help_command=help_command, description='This is a bot to assist in starting Minecraft servers')
+loop_lag_task = None # The task monitoring the event loop lag. This is started once the bot is ready
+
+class TimedContext(commands.Context):
+    """The context commands are run in. This is the same as the default context, except that the time
+    every message takes to send is recorded in the metrics."""
+
+    async def send(self, *args, **kwargs):
+        """Send a message, and time how long it takes."""
+        with metrics.timer('discord_send_seconds'): # Time sending the message
+            return await super().send(*args, **kwargs) # Send the message
+
+bot_options = {} # Extra options for the bot, depending on the version of discord.py
+if discord.version_info.major >= 2: # Check if discord.py requires intents, which it didn't when the bot was written
+    bot_options['intents'] = discord.Intents.default() # If so, use the default intents...
+    bot_options['intents'].message_content = True # and read the content of messages, which commands need
+
+client = commands.Bot(command_prefix = prefix, help_command=help_command, description='This is a bot to assist in starting Minecraft servers', **bot_options)
+
+@client.event
+async def on_message(message):
+    """Called when a message is sent. This runs any command in the message, in a TimedContext."""
+    if message.author.bot: # Check if the message was sent by a bot
+        return # If so, ignore it, like the default does
+
+    ctx = await client.get_context(message, cls=TimedContext) # Get the context of the message
+    await client.invoke(ctx) # Run the command in the message, if there is one
+
+@client.before_invoke
+async def before_command(ctx):
+    """Called before every command. This stores the time the command started at."""
+    ctx.started = time.perf_counter() # Store the time the command started at
+
+@client.after_invoke
+async def after_command(ctx):
+    """Called after every command, even if it failed. This records how long the command took."""
+    metrics.observe('command_seconds', time.perf_counter() - ctx.started, command=ctx.command.qualified_name) # Record how long the command took
 
 @client.event
 async def on_ready():
     """Called when the bot is initialized."""
     print('Autobots, Roll Out!') # Print a message to the console to aknkowledge the status
 
+    global loop_lag_task
+    if not loop_lag_task: # Check if the event loop is not being monitored yet. on_ready can be called more than once, after reconnecting
+        use_pidfd_child_watcher() # Wait for servers from the event loop, instead of from a thread per server
+        loop_lag_task = asyncio.create_task(monitor_loop_lag(threshold=config.getfloat('DEFAULT', 'loop_lag_warning', fallback=0.25))) # Start monitoring the event loop
+        run_in_background(sample_resources(config.getfloat('DEFAULT', 'metrics_interval', fallback=15.0))) # Start sampling the resources used by the servers
+
+        metrics_port = config.getint('DEFAULT', 'metrics_port', fallback=None) # Get the port to serve the metrics on, if any
+        if metrics_port: # Check if the metrics should be served
+            await asyncio.start_server(serve_metrics, '127.0.0.1', metrics_port) # If so, start serving them on localhost
+            print(f'Serving metrics on http://127.0.0.1:{metrics_port}/metrics') # Print a message to the console to inform of the current status
+
 # When the bot sees specific message (.help)
 @client.command(
     name='helpme',
@@ -144,123 +775,554 @@ async def clear(ctx, amount=6):
 # -------------------------- User input to Bot output section --------------------------- #
 # --------------------------------------------------------------------------------------- #
 
-def get_server_dirs():
-    """Utility function to get a list of server directories. The objective of this function is to
-    look through the server directory for subdirectories. From there, it will check the contents of
-    those subdirectories, looking for a start file. If none is found, the directory is ignored, and
-    the next one is checked. If it does have a start file, it is appended to the list of server
-    directories, which is returned."""
-    dirs = [f for f in os.listdir(server_dir) if path.isdir(path.join(server_dir, f))] # Get a list of subdirectories in server_dir
-    server_dirs = [] # A list of server directories. This will be populated when the subdirectories are checked.
-
-    for dir_tmp in dirs: # Iterate through the subdirectories
-        dir = path.join(server_dir, dir_tmp) # Construct an absolute path to the subdirectory
-        files = [f for f in os.listdir(dir) if path.isfile(path.join(dir, f))] # Get the files in the subdirectory
+START_FILES = ('start.bat', 'run.bat') if os.name == 'nt' else ('start.sh', 'run.sh') # The names of start files that are recognized, in increasing order of preference
 
-        start_file = None # The name of the start file. This is initially None to represent that there is no start file.
-        if 'start.bat' in files: # Check if start.bat is a file in the subdirectory
-            start_file = 'start.bat' # If so, set the start file to it
-        if 'run.bat' in files: # Check if run.bat is a file in the subdirectory
-            start_file = 'run.bat' # If so, set the start file to it
+def find_start_file(files):
+    """Find the start file in a list of file names. This checks each of the recognized start file
+    names, and the last one that is found wins, so run.bat is preferred over start.bat, and run.sh
+    over start.sh. Windows uses batch files and everything else uses shell scripts. If none of them
+    are found, None is returned to represent that there is no start file."""
+    start_file = None # The name of the start file. This is initially None to represent that there is no start file.
+    for name in START_FILES: # Check each of the recognized start file names in order of preference
+        if name in files: # Check if the start file is in the list of files
+            start_file = name # If so, set the start file to it
+
+    return start_file # Return the start file, or None if there wasn't one
+
+def read_metadata(server, server_config_file):
+    """Read a metadata file into a server dictionary. The metadata file is an ini file with an
+    optional server section. Every value in that section that the server dictionary knows about is
+    copied over, and everything else is left as it was."""
+    server_config = configparser.ConfigParser() # Create a configuration parser for the metadata file
+    server_config.read(server_config_file) # Read and parse the contents of the metadata file
+
+    if not server_config.has_section('server'): # Check if there is a server section. It is optional
+        return # If there isn't, there is nothing to read
+
+    server_info = server_config['server'] # Get the server section
+    for key in ('description', 'version', 'mods', 'ip', 'memory'): # Loop through each of the values that can be specified in the metadata
+        if key in server_info: # Check if the value is in the metadata
+            server[key] = server_info[key] # Set the value of the server info to the value from the metadata
+
+def stat_mtime(file):
+    """Get the modification time of a file, in nanoseconds. If the file doesn't exist, None is returned
+    instead, so that a file being created or removed also counts as a change."""
+    try: # Try to stat the file
+        return os.stat(file).st_mtime_ns # Return the modification time
+    except FileNotFoundError: # Catch if the file doesn't exist
+        return None # Return None to represent that there is no file
+
+class ServerCatalog:
+    """A cached catalog of the servers in the server directory. Instead of scanning every server
+    directory each time the list of servers is needed, the catalog keeps the start file and parsed
+    metadata of each server in memory. It is refreshed incrementally: the server directory is only
+    listed again when its modification time changes, and a server directory is only re-read when its
+    own modification time or that of its metadata file changes. Refreshes are also throttled, so that
+    a burst of commands only checks the filesystem once. Looking up a server is a dictionary lookup.
+    A refresh reads into copies of the catalog, which are swapped in once it is done, so looking up a
+    server never waits for the filesystem, even while another thread is refreshing."""
+
+    def __init__(self, root, refresh_interval=5.0):
+        """Initialize the variables. The catalog starts out empty, and will be filled by the first
+        refresh."""
+        self.root = root # Store the directory containing the server directories
+        self.refresh_interval = refresh_interval # The minimum amount of seconds between refreshes
+        self.servers = {} # A dictionary of server names to server dictionaries. Only directories with a start file are in here
+        self.dirs = {} # A dictionary of subdirectory names to the modification times they were last read at
+        self.root_mtime = None # The modification time of the server directory when it was last listed
+        self.last_refresh = None # The time of the last refresh, used to throttle refreshes
+        self.refresh_lock = threading.Lock() # A lock so that the catalog isn't refreshed from two threads at once
+        self.lock = threading.Lock() # A lock so that the catalog isn't read while a refresh swaps in its results. This is only held briefly, never while reading the filesystem
+
+    def refresh(self, force=False):
+        """Refresh the catalog. If the catalog was refreshed less than refresh_interval seconds ago,
+        nothing happens unless force is set. Otherwise, the server directory is listed if it has
+        changed, and every subdirectory that has changed is read again. The changes are made to copies
+        of the catalog, which replace it at the end."""
+        with self.refresh_lock: # Make sure only one refresh happens at a time
+            now = time.monotonic() # Get the current time
+            if not force and self.last_refresh is not None and now - self.last_refresh < self.refresh_interval: # Check if the catalog was refreshed recently
+                return # If so, the catalog is fresh enough
+
+            self.last_refresh = now # Store the time of this refresh
+            servers, dirs = dict(self.servers), dict(self.dirs) # Copy the catalog, so it can still be read while it is being refreshed
+
+            with metrics.timer('catalog_refresh_seconds'): # Time the refresh
+                root_mtime = os.stat(self.root).st_mtime_ns # Get the modification time of the server directory
+                if root_mtime != self.root_mtime: # Check if subdirectories may have been added or removed
+                    names = set(entry.name for entry in os.scandir(self.root) if entry.is_dir()) # Get a set of subdirectories in the server directory
+                    for name in set(dirs) - names: # Loop through the subdirectories that have been removed
+                        self.forget(name, servers, dirs) # Remove them from the catalog
+
+                    self.root_mtime = root_mtime # Store the modification time the server directory was listed at
+                else:
+                    names = set(dirs) # The subdirectories haven't changed, so just check the known ones
+
+                for name in names: # Loop through each subdirectory
+                    self.refresh_dir(name, servers, dirs) # Read it again if it has changed
+
+            with self.lock: # Make sure nothing is reading the catalog while it is replaced
+                self.servers, self.dirs = servers, dirs # Replace the catalog with the refreshed copies
+            metrics.set('catalog_servers', len(servers)) # Record how many servers there are
+
+    def refresh_dir(self, name, servers, dirs):
+        """Refresh a single server directory in the given copies of the catalog. The modification times
+        of the directory and its metadata file are compared to the ones it was last read at, and the
+        directory is only read again if either has changed."""
+        dir = path.join(self.root, name) # Construct an absolute path to the subdirectory
+        server_config_file = path.join(dir, 'metadata.ini') # Construct a path to a metadata file
+        mtimes = (stat_mtime(dir), stat_mtime(server_config_file)) # Get the modification times of the directory and the metadata file
+
+        if mtimes[0] is None: # Check if the directory has been removed since it was listed
+            self.forget(name, servers, dirs) # If so, remove it from the catalog...
+            return # and stop
+
+        if dirs.get(name) == mtimes: # Check if nothing has changed since the directory was last read
+            return # If so, the cached information is still valid
+
+        dirs[name] = mtimes # Store the modification times the directory was read at
 
-        if not start_file: # Check if there is still no start file in the subdirectory
+        files = [f for f in os.listdir(dir) if path.isfile(path.join(dir, f))] # Get the files in the subdirectory
+        start_file = find_start_file(files) # Find the start file in the subdirectory
+        if not start_file: # Check if there is no start file in the subdirectory
             print(f'No start file in {dir}. Ignoring.') # If there is no start file, log a message to the console...
-            continue # and continue without adding it as a server directory
+            servers.pop(name, None) # and make sure it isn't in the catalog
+            return
+
+        server = {'name': name, 'description': None, 'version': None, 'mods': None, 'ip': None, 'memory': None, 'start_file': start_file} # Initialize the server with some default data. This can be overriden later
+        if mtimes[1] is not None: # Check if the metadata file exists
+            with metrics.timer('metadata_parse_seconds'): # Time reading the metadata
+                read_metadata(server, server_config_file) # Read the metadata into the server
+
+        servers[name] = server # Add the server to the catalog
+
+    def forget(self, name, servers, dirs):
+        """Remove a subdirectory from the given copies of the catalog. This is used when a subdirectory
+        is removed from the server directory."""
+        dirs.pop(name, None) # Forget the modification times of the subdirectory
+        servers.pop(name, None) # Remove the server, if it was one
+
+    def get(self, name):
+        """Get a server by name. This returns the cached server dictionary, or None if there is no
+        server with that name. The catalog is not refreshed, so refresh should be called first if
+        up to date information is required."""
+        with self.lock: # Make sure a refresh isn't replacing the catalog at the same time
+            return self.servers.get(name) # Look up the server
+
+    def has_dir(self, name):
+        """Check if a subdirectory is known to the catalog, regardless of whether it has a start file."""
+        with self.lock: # Make sure the catalog isn't being refreshed by another thread at the same time
+            return name in self.dirs # Look up the subdirectory
+
+    def list(self):
+        """Get a list of all of the servers, sorted by name. Each server is a copy, so it can be
+        modified without affecting the catalog. A refresh replaces the catalog instead of changing it,
+        so the servers are copied without holding the lock."""
+        with self.lock: # Make sure a refresh isn't replacing the catalog at the same time
+            servers = self.servers # Get the current catalog
+        return [dict(servers[name]) for name in sorted(servers)] # Copy each server, in order of name
+
+catalog = ServerCatalog(server_dir, config.getfloat('DEFAULT', 'catalog_refresh_interval', fallback=5.0)) # Create the server catalog
 
-        server_dirs.append(dir_tmp) # Append the directory as a server directory
-
-    return server_dirs # Return the populated list of server directories
+def get_server_dirs():
+    """Utility function to get a list of server directories. The objective of this function is to
+    look through the server directory for subdirectories that contain a start file. This is answered
+    from the server catalog, which only reads the subdirectories that have changed since the last
+    time it was refreshed."""
+    catalog.refresh() # Make sure the catalog is up to date
+    return [server['name'] for server in catalog.list()] # Return the list of server directories
 
 def get_server_list():
     """Get a list of servers. This is called every time the run command is called, and should
     check to see what servers are available. The output is a list of dictionaries. Each dictionary
-    represents a single server. Each server has a name, a version, and a mods key. They are all
-    strings, so they can be filled with whatever data may be useful. The only restriction is that
-    the name cannot contain any spaces, as that would conflict with selecting a server using the
-    run command. To find the pertinent information, first the servers directory should be polled
-    for subdirectories. Each of those should then be check to see if it has a batch start file.
-    A few names should be checked for compatibility, for example 'start.bat', 'run.bat', etc.
-    Just having a batch start file is enough to be recognized as a server. If no other information
-    is found, it should be initialized to 'Unknown'. To find metadata, the individual server
-    directories should be polled for a metadata file. This file should contain the necessary
-    metadata, but doesn't need to specify everything. Right now, a list is hard-coded for testing"""
-    dirs = get_server_dirs() # Get a list of server directories
-    servers = [] # A list of servers. This will be populated depending on the contents of the server directories
-
-    for dir in dirs: # Iterate through each server directory
-        server = {'name': dir, 'description': None, 'version': None, 'mods': None, 'ip': None} # Initialize the server with some default data. This can be overriden later
-        servers.append(server) # Add the server to the list of servers
-
-        server_config_file = path.join(server_dir, dir, 'metadata.ini') # Construct a path to a metadata file
-        if path.exists(server_config_file) and path.isfile(server_config_file): # Check if the metadata file exists and is an actual file
-            server_config = configparser.ConfigParser() # Create a configuration parser for the metadata file
-            server_config.read(server_config_file) # Read and parse the contents of the metadata file
-
-            server_info = server_config['server'] # Get the server section. This could be None if it does not exist. It is optional
-            if server_info: # Check if there is a server section
-                if 'description' in server_info:
-                    server['description'] = server_info['description']
-
-                if 'version' in server_info: # Check if there is a version value
-                    server['version'] = server_info['version'] # Set the version of the server info to the version from the metadata
-
-                if 'mods' in server_info: # Check if there is a mods value
-                    server['mods'] = server_info['mods'] # Set the mods of the server info to the mods from the metadata
-
-                if 'ip' in server_info:
-                    server['ip'] = server_info['ip']
-
-    return servers # Return the populated list of servers
-
-def start_server(name):
-    """Actually start a server. This should be called whenever a server is meant to be started.
-    First, we need to check to make sure the inputted server name is valid. To do that, we check
-    to make sure we have a valid variable for name. If not, throw a TypeError. Next, we need to
-    check if the server is found. To do that, we need to search the servers directory and check if
-    the specified name is a directory in there. If it's not, throw a ValueError. The server directory
-    should be specified in a configuration file in the same directory as the script. Next, we need to
-    check if the server is already running. This should be done by querying the OS to see if there
-    is a process already started for the server. If the server is already running, throw a RuntimeError.
-    Next, we need to actually start the server. This is as simple as just calling the batch file
-    if the server's directory. Any reason that the server should not be started should be logged to
-    the console."""
+    represents a single server. Each server has a name, a description, a version, a mods key, an ip
+    and a start file. They are all strings, so they can be filled with whatever data may be useful.
+    The only restriction is that the name cannot contain any spaces, as that would conflict with
+    selecting a server using the run command. Just having a start file is enough to be recognized as
+    a server, and any metadata that isn't found is left as None. The servers come from the server
+    catalog, so only server directories that changed since the last call are actually read again."""
+    catalog.refresh() # Make sure the catalog is up to date
+    return catalog.list() # Return a copy of the servers in the catalog
+
+def find_server(name):
+    """Find the start file of a server that should be started. First, we need to check to make sure
+    the inputted server name is valid. To do that, we check to make sure we have a valid variable for
+    name. If not, throw a TypeError. Next, we need to check if the server is found. To do that, we look
+    the specified name up in the server catalog, which knows about every directory in the servers
+    directory. If it's not there, or doesn't have a start file, throw a ValueError. The server
+    directory should be specified in a configuration file in the same directory as the script. Next,
+    we need to check if the server is already running. This is done by looking the server up in the
+    process registry, and checking with the OS that its process is still alive. If the server is
+    already running, throw a RuntimeError. Otherwise, the absolute path to the start file is returned.
+    Any reason that the server should not be started should be logged to the console."""
     if not name or not isinstance(name, str): # Check to see if the inputted name is valid.
         raise TypeError('Received an invalid argument') # If the name is not valid, throw a type error.
 
+    catalog.refresh() # Make sure the catalog is up to date, so that newly added servers can be started
     server_path = path.join(server_dir, name) # Construct an absolute path to the server's directory
-    if not path.exists(server_path) or not path.isdir(server_path): # Check if the server path exists and is an actual directory
+    if not catalog.has_dir(name): # Check if the server directory is a subdirectory of the server directory
         print(f'{server_path} was not a valid server directory') # If not, print a message to the console...
         raise ValueError('The server path is invalid') # and raise a value error
 
-    server_files = [f for f in os.listdir(server_path) if path.isfile(path.join(server_path, f))] # Get a list of files in the server's directory
-    start_file = None # The name of the start file. This is initially None to represent that there is no start file.
-    if 'start.bat' in server_files: # Check if start.bat is a file in the subdirectory
-        start_file = 'start.bat' # If so, set the start file to it
-    if 'run.bat' in server_files: # Check if run.bat is a file in the subdirectory
-        start_file = 'run.bat' # If so, set the start file to it
-
-    if not start_file: # Check if there is still no start file in the subdirectory
+    server = catalog.get(name) # Look up the server in the catalog. This is None if the directory doesn't have a start file
+    if not server: # Check if there is no start file in the subdirectory
         print(f'{server_path} did not contain a valid start file') # If there is no start file, log an error message to the console...
         raise ValueError('A start file could not be found') # And raise a value error
 
-    start_path = path.join(server_path, start_file) # Construct an absolute path to the start file
-    for process in psutil.process_iter(): # Iterate through all of the running processes
-        try: # Use try in order to catch any permission errors (They may occur if a process is set to not be visible to specific users)
-            if start_path in process.cmdline() and process.status() == psutil.STATUS_RUNNING: # Check if the process' command line command contains the start file and is running (our assumption that that's the process that started it)
-                print(f'PID {process.pid} is already running for {start_path}') # If so, print a message to the console...
-                raise RuntimeError('The server is already running') # and raise a runtime error
-        except RuntimeError: # Catch a runtime error in specific, because we want to ignore it
-            raise # Re-raise the runtime error, because that denotes that a server is already running
-        except: # Catch any exceptions that may have occured
-            pass # Discard any exceptions
+    start_path = path.join(server_path, server['start_file']) # Construct an absolute path to the start file
+    with metrics.timer('running_check_seconds'): # Time the check for whether the server is running
+        pid = registry.get_pid(name) # Look up the process of the server in the process registry
+    if pid: # Check if the server has a process that is still alive
+        print(f'PID {pid} is already running for {start_path}') # If so, print a message to the console...
+        raise RuntimeError('The server is already running') # and raise a runtime error
+
+    return start_path # Return the path to the start file
 
-    print(f'Starting server "{name}"') # Print a log message to the console to inform of the current status
+# --------------------------------------------------------------------------------------- #
+# ------------------------------- Async service section --------------------------------- #
+# --------------------------------------------------------------------------------------- #
+
+executor = ThreadPoolExecutor(max_workers=config.getint('DEFAULT', 'max_workers', fallback=4), thread_name_prefix='worker') # A bounded pool of threads to run blocking filesystem and process work in
+server_locks = {} # A dictionary of server names to locks, so that a server can't be started twice at the same time
+loop_lag = {'last': 0.0, 'max': 0.0} # The last and the largest measured event loop lag, in seconds
+
+async def run_blocking(func, *args):
+    """Run a blocking function in the worker pool. Commands should use this for anything that touches
+    the filesystem or other processes, so that the event loop stays free to handle other commands and
+    the gateway heartbeat in the meantime."""
+    loop = asyncio.get_running_loop() # Get the event loop this is running in
+    return await loop.run_in_executor(executor, functools.partial(func, *args)) # Run the function in the worker pool and wait for its result
+
+background_tasks = set() # The tasks running in the background that nothing else keeps. The event loop only keeps weak references to tasks, so they are kept here until they are done
+
+def run_in_background(coro):
+    """Run a coroutine in a task that nothing waits for. The task is kept until it is done, so it
+    can't be garbage collected while it is still running."""
+    task = asyncio.create_task(coro) # Create the task
+    background_tasks.add(task) # Keep it...
+    task.add_done_callback(background_tasks.discard) # until it is done
+    return task # Return the task
+
+async def get_server_list_async():
+    """Get a list of servers without blocking the event loop. This is the same as get_server_list,
+    but the catalog is refreshed in the worker pool."""
+    return await run_blocking(get_server_list) # Get the list of servers in the worker pool
+
+async def start_server(name):
+    """Actually start a server. This should be called whenever a server is meant to be started. The
+    server is looked up with find_server in the worker pool, which raises if it can't or shouldn't be
+    started, and is then handed to the supervisor to run. Starting a server holds a lock for that
+    server, so that two commands starting the same server at the same time can't both get past the
+    check for whether it is already running."""
+    lock = server_locks.setdefault(name, asyncio.Lock()) # Get the lock for the server, creating it if it doesn't exist yet
+    async with lock: # Make sure nothing else is starting the server at the same time
+        start_path = await run_blocking(find_server, name) # Find the start file of the server in the worker pool
+
+        print(f'Starting server "{name}"') # Print a log message to the console to inform of the current status
+        address = parse_address(catalog.get(name)['ip']) # Get the address of the server from its metadata, so the supervisor can tell when it is ready
+        await supervisor.start(name, path.dirname(start_path), start_path, address) # Hand the server to the supervisor
+        print(f'Started {name}') # Print a log message to the console to inform of the current status
+
+async def monitor_loop_lag(interval=1.0, threshold=0.25):
+    """Measure how responsive the event loop is. This sleeps for a fixed interval over and over, and
+    measures how much later than requested it actually wakes up. That difference is the time the
+    event loop was blocked by something else. If it is over the threshold, a warning is printed to
+    the console."""
+    loop = asyncio.get_running_loop() # Get the event loop this is running in
+    while True: # Keep measuring for as long as the bot is running
+        before = loop.time() # Get the time before sleeping
+        await asyncio.sleep(interval) # Sleep for the interval
+        lag = loop.time() - before - interval # Figure out how much longer than the interval the sleep took
+
+        loop_lag['last'] = lag # Store the last measured lag
+        loop_lag['max'] = max(lag, loop_lag['max']) # Update the largest measured lag
+        metrics.set('event_loop_lag_seconds', lag) # Record the last measured lag
+        metrics.set('event_loop_lag_max_seconds', loop_lag['max']) # Record the largest measured lag
+        if lag > threshold: # Check if the event loop was blocked for too long
+            print(f'The event loop was blocked for {lag:.3f}s') # If so, print a warning to the console
+
+process_cache = {} # A dictionary of PIDs to their psutil processes. CPU usage is measured since the last sample, so the same process objects have to be used every time
+
+def sample_processes(pids):
+    """Sample the CPU and memory usage of several servers in a single pass. The argument is a
+    dictionary of server names to the PIDs of their processes, and the result is a dictionary of
+    server names to their CPU usage in percent and their resident memory in bytes. The children of
+    each process are included, since a start file usually runs the actual server as a child. This
+    reads from the OS, so it should be run in the worker pool."""
+    samples = {} # The usage of each server
+    seen = set() # The PIDs that were sampled, so processes that are gone can be dropped from the cache
+    for name, pid in pids.items(): # Loop through each server
+        cpu, rss = 0.0, 0 # The total usage of the server's processes
+        try: # Try to get the processes of the server
+            root = process_cache.get(pid) or psutil.Process(pid) # Get the process of the server, reusing the cached one if there is one
+            processes = [root] + root.children(recursive=True) # Get the process and all of its children
+        except psutil.Error: # Catch if the process is gone or can't be accessed
+            continue # If so, there is nothing to sample
+
+        for process in processes: # Loop through each of the processes
+            process = process_cache.setdefault(process.pid, process) # Use the cached process object if there is one
+            seen.add(process.pid) # Remember that the process was sampled
+            try: # Try to sample the process
+                with process.oneshot(): # Read everything about the process at once
+                    cpu += process.cpu_percent() # Add its CPU usage since the last sample
+                    rss += process.memory_info().rss # Add its resident memory
+            except psutil.Error: # Catch if the process exited in the meantime
+                pass # If so, it doesn't use anything anymore
+
+        samples[name] = (cpu, rss) # Store the usage of the server
+
+    for pid in set(process_cache) - seen: # Loop through the processes that weren't sampled
+        del process_cache[pid] # They are gone, so drop them from the cache
+
+    return samples # Return the usage of each server
+
+async def sample_resources(interval=15.0):
+    """Sample the CPU and memory usage of every running server every interval seconds, and record it
+    in the metrics. Every server is sampled in one pass in the worker pool."""
+    while True: # Keep sampling for as long as the bot is running
+        try: # Try to sample the servers
+            pids = {name: info['pid'] for name, info in registry.snapshot().items()} # Get the PID of every running server
+            samples = await run_blocking(sample_processes, pids) # Sample them in the worker pool
+
+            metrics.clear('server_cpu_percent') # Remove the usage of servers that are no longer running
+            metrics.clear('server_rss_bytes')
+            for name, (cpu, rss) in samples.items(): # Loop through the usage of each server
+                metrics.set('server_cpu_percent', cpu, server=name) # Record its CPU usage
+                metrics.set('server_rss_bytes', rss, server=name) # Record its resident memory
+        except Exception: # Catch any exceptions, so a single failed sample doesn't stop sampling
+            print('Error sampling server resources:\n') # Print a console message to help identify issues
+            traceback.print_exc() # Print the full error
 
-    server_thread = ServerThread(server_path, start_path) # Create a server thread and initialize it with the start path
-    server_thread.start() # Start the server thread
-    server_threads.append(server_thread) # Add the server thread to the server threads list for future use (i.e. stopping)
+        await asyncio.sleep(interval) # Wait before sampling again
+
+async def serve_metrics(reader, writer):
+    """Serve the metrics over HTTP, in the Prometheus text format. This is a minimal HTTP server that
+    answers GET /metrics, and nothing else."""
+    try: # Make sure the connection is closed when done
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5) # Read the request
+        method, target = (request.split(b' ') + [b'', b''])[:2] # Get the method and the path of the request
+        if method == b'GET' and target.split(b'?')[0] == b'/metrics': # Check if the metrics were requested
+            status, body = '200 OK', metrics.render() # If so, render them
+        else:
+            status, body = '404 Not Found', 'Not found\n' # Otherwise, there is nothing here
+
+        body = body.encode() # Encode the body
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body) # Send the response
+        await writer.drain() # Wait for the response to be sent
+    except (OSError, EOFError, asyncio.LimitOverrunError, asyncio.TimeoutError): # Catch if the request is broken or takes too long
+        pass # If so, just close the connection
+    finally:
+        writer.close() # Close the connection
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4} # The units a size can be given in, and how many bytes they are
+
+def parse_size(size):
+    """Parse a size like 6G or 512M into a number of bytes. The unit can be K, M, G or T, optionally
+    followed by B, and a size without a unit is in bytes. If the size can't be parsed, a ValueError
+    is raised."""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*', size, re.IGNORECASE) # Split the size into a number and a unit
+    if not match: # Check if the size isn't in a known format
+        raise ValueError(f'Invalid size {size!r}') # If so, raise a value error
+
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()]) # Return the size in bytes
+
+class QueuedStart:
+    """A server waiting in the start queue, or starting after being let out of it."""
+
+    def __init__(self, name, memory, future):
+        """Initialize the variables. The future is resolved when the server is let out of the queue."""
+        self.name = name # Store the name of the server
+        self.memory = memory # Store the amount of memory the server needs, in bytes, or None if it isn't known
+        self.future = future # Store the future that is resolved when the server can start
+        self.queued = time.monotonic() # The time the server was queued at
+        self.started = None # The time the server was let out of the queue at
+
+class StartQueue:
+    """The queue of servers waiting to start. A server is only let out of the queue once it fits on
+    the host: fewer than max_parallel servers can be starting, the available memory minus what the
+    servers that are still starting will use has to leave room for the server's memory hint and the
+    reserve, and the load per CPU has to be under max_load. Servers are let out in the order they were
+    queued, so a big server can't be starved by small ones. The queue is checked again whenever a
+    server is done starting, and every few seconds while anything is waiting, since memory can be
+    freed by other processes too."""
+
+    def __init__(self, max_parallel=2, memory_reserve=0, max_load=None, poll_interval=5.0):
+        """Initialize the variables. If max_load is None, the load isn't checked."""
+        self.max_parallel = max_parallel # The maximum amount of servers starting at once
+        self.memory_reserve = memory_reserve # The amount of memory to always leave available, in bytes
+        self.max_load = max_load # The maximum load per CPU to start servers at, or None to not check it
+        self.poll_interval = poll_interval # How often to check the queue while anything is waiting, in seconds
+        self.pending = collections.deque() # The servers waiting to start, in the order they were queued
+        self.starting = {} # A dictionary of server names to the servers that have been let out of the queue and are starting
+        self.poller = None # The task checking the queue every few seconds, while anything is waiting
+
+    def fits(self, entry):
+        """Check if a server fits on the host right now."""
+        if len(self.starting) >= self.max_parallel: # Check if too many servers are already starting
+            return False # If so, the server has to wait
+
+        if self.max_load is not None and psutil.getloadavg()[0] / (psutil.cpu_count() or 1) > self.max_load: # Check if the host is too busy
+            return False # If so, the server has to wait
+
+        if entry.memory: # Check if the server has a memory hint
+            reserved = sum(start.memory or 0 for start in self.starting.values()) # Add up the memory the servers that are still starting will use
+            if psutil.virtual_memory().available - reserved - self.memory_reserve < entry.memory: # Check if there isn't enough memory left for the server
+                return False # If so, the server has to wait
+
+        return True # Otherwise, the server fits
+
+    def admit(self):
+        """Let servers out of the queue for as long as the first one in line fits."""
+        while self.pending and self.fits(self.pending[0]): # Keep going while the first server in line fits
+            entry = self.pending.popleft() # Take the server out of the queue
+            entry.started = time.monotonic() # Store the time the server was let out of the queue
+            self.starting[entry.name] = entry # It is now starting
+            entry.future.set_result(None) # Let the server start
+
+        if self.pending and not self.poller: # Check if servers are still waiting and the queue isn't being checked yet
+            self.poller = asyncio.create_task(self.poll()) # If so, start checking the queue every few seconds
+
+    async def poll(self):
+        """Check the queue every few seconds, for as long as anything is waiting in it."""
+        try: # Make sure the poller is cleared when it stops
+            while self.pending: # Keep checking while anything is waiting
+                await asyncio.sleep(self.poll_interval) # Wait before checking again
+                self.admit() # Check the queue
+        finally:
+            self.poller = None # The queue is no longer being checked
+
+    def check(self, memory):
+        """Check if a server could ever fit on the host. If it needs more memory than the host has in
+        total, it would wait in the queue forever, so a ValueError is raised. This should be called
+        before waiting for a slot."""
+        if memory and memory > psutil.virtual_memory().total - self.memory_reserve: # Check if the server could never fit
+            raise ValueError('The server needs more memory than the host has') # If so, raise a value error
+
+    @contextlib.asynccontextmanager
+    async def slot(self, name, memory=None):
+        """Wait in the queue until a server fits on the host, and hold its place among the starting
+        servers until the block is left."""
+        entry = QueuedStart(name, memory, asyncio.get_running_loop().create_future()) # Create the entry in the queue
+        self.pending.append(entry) # Add it to the end of the queue
+        self.admit() # Let it out right away if it fits
+
+        try: # Try to wait for the server to be let out of the queue
+            await entry.future # Wait for the server to be let out of the queue
+        except asyncio.CancelledError: # Catch if waiting was cancelled
+            if entry in self.pending: # Check if the server was still waiting
+                self.pending.remove(entry) # If so, take it out of the queue
+            raise # Re-raise the cancellation
+
+        try: # Let the server start
+            yield
+        finally:
+            if self.starting.get(name) is entry: # Check if the server is still counted as starting
+                del self.starting[name] # If so, it is done starting
+            self.admit() # Let the next servers out of the queue, now that there is room
+
+    def estimate(self):
+        """Estimate how long each server in the queue will wait, in seconds. This simulates the servers
+        starting one after another in the slots, using how long each server usually takes to start.
+        It doesn't know when memory will be freed, so it is only a rough guess. The result is a list of
+        each queued server and its estimated wait, in the order of the queue."""
+        all_times = [t for times in supervisor.startup_times.values() for t in times] # Get every recorded startup time
+        typical = percentile(all_times, 50) or 60.0 # Use the median startup time for servers that have never started, or a minute if nothing has
+
+        def usual(name):
+            """Get how long a server usually takes to start."""
+            return percentile(supervisor.startup_times.get(name), 50) or typical # Use the median startup time of the server, or the typical one
+
+        now = time.monotonic() # Get the current time
+        slots = [max(usual(start.name) - (now - start.started), 0.0) for start in self.starting.values()] # Figure out how long each starting server has left
+        slots += [min(slots, default=0.0)] * max(self.max_parallel - len(slots), 0) # Add the free slots. Anything waiting doesn't fit right now, so they are only usable once the first starting server is done
+        heapq.heapify(slots) # Keep the slots ordered by when they are free
+
+        estimates = [] # The estimated wait of each queued server
+        for entry in self.pending: # Loop through the queue in order
+            wait = heapq.heappop(slots) # The server starts in the first slot that is free
+            estimates.append((entry, wait)) # Record its wait
+            heapq.heappush(slots, wait + usual(entry.name)) # The slot is free again once the server has started
+
+        return estimates # Return the estimates
+
+start_queue = StartQueue( # Create the start queue
+    max_parallel=config.getint('DEFAULT', 'max_parallel_starts', fallback=2),
+    memory_reserve=parse_size(config.get('DEFAULT', 'memory_reserve', fallback='1G')),
+    max_load=config.getfloat('DEFAULT', 'max_load', fallback=None))
+
+class StatusMessage:
+    """A single message showing the status of several servers. Instead of sending a message for each
+    thing that happens, the status of each server is updated in place, and the message is edited to
+    match. Edits are debounced, so that a burst of updates only results in one edit, and the message
+    is edited at most once per interval to stay within the rate limits."""
+
+    max_size = 2000 # The maximum length of a message
+
+    def __init__(self, ctx, title, interval=1.5):
+        """Initialize the variables. The message isn't sent until send is called."""
+        self.ctx = ctx # Store the context to send the message in
+        self.title = title # Store the title shown above the statuses
+        self.interval = interval # The minimum amount of seconds between edits
+        self.states = {} # A dictionary of server names to their status. Dictionaries keep their order, so servers are shown in the order they were added
+        self.message = None # The message, once it has been sent
+        self.shown = None # The content the message was last sent or edited with
+        self.last_edit = 0.0 # The time of the last edit
+        self.pending = None # The task that will edit the message, if an edit is scheduled
+
+    def render(self):
+        """Build the content of the message. If the statuses don't fit in a single message, the ones
+        that don't fit are left out, and a note says how many there are."""
+        max_size = max((len(name) for name in self.states), default=0) # Get the length of the longest server name
+        lines = ['{0:<{width}}  {1}'.format(name, state, width=max_size) for name, state in self.states.items()] # Build a line for each server
+
+        msg = f'```{self.title}' # Begin the message string
+        for index, line in enumerate(lines): # Loop through each line
+            if len(msg) + len(line) + 40 > self.max_size: # Check if the line wouldn't leave room for the note and the end of the code block
+                msg += f'\n... and {len(lines) - index} more' # If so, add a note about the lines that are left out...
+                break # and stop adding lines
+
+            msg += f'\n{line}' # Add the line
+        msg += '```'
 
-    print(f'Started {name}') # Print a log message to the console to inform of the current status
+        return msg # Return the content of the message
+
+    async def send(self):
+        """Send the message with the current statuses."""
+        self.shown = self.render() # Build the content of the message
+        self.message = await self.ctx.send(self.shown) # Send the message
+        self.last_edit = time.monotonic() # Count sending as an edit, for the debouncing
+
+    def set(self, name, state):
+        """Update the status of a server. The message is edited after a short delay, unless an edit is
+        already scheduled, in which case that edit will include this update."""
+        self.states[name] = state # Update the status of the server
+        if self.message and not self.pending: # Check if the message has been sent and there is no edit scheduled yet
+            self.pending = asyncio.create_task(self.edit_later()) # If so, schedule one
+
+    async def edit_later(self):
+        """Wait until the message can be edited again, then edit it."""
+        await asyncio.sleep(max(self.last_edit + self.interval - time.monotonic(), 0)) # Wait until the interval since the last edit has passed
+        self.pending = None # The edit is no longer scheduled, so updates from now on schedule another
+        await self.edit() # Edit the message
+
+    async def edit(self):
+        """Edit the message to show the current statuses, if they have changed since it was last shown."""
+        content = self.render() # Build the content of the message
+        if content == self.shown: # Check if nothing has changed
+            return # If so, there is no need to edit the message
+
+        self.shown = content # Store the content the message is edited with
+        self.last_edit = time.monotonic() # Store the time of the edit
+        with metrics.timer('discord_edit_seconds'): # Time the edit
+            await self.message.edit(content=content) # Edit the message
+
+    async def close(self):
+        """Edit the message one last time, right away, so that it shows the final statuses."""
+        if self.pending: # Check if there is an edit scheduled
+            self.pending.cancel() # If so, cancel it, since the message is edited right away instead
+            self.pending = None # The edit is no longer scheduled
+
+        await self.edit() # Edit the message
 
 @commands.check_any(commands.has_role(f'{bot_role}'), commands.has_permissions(administrator=True)) # Only allow people to start server that have the role or are administrators
 @client.command(
@@ -276,7 +1338,7 @@ async def run(ctx, *input):
     function. Next we need to check to see if we have any input. If not, send a list of servers with
     their respective information. If we do have input, loop through it and check to see if each inputted
     server is valid. If one isn't just ignore it. For every server that is valid, pass it to the"""
-    servers = get_server_list() # Get an updated list of servers. This will check each time the command is run, so new servers can be added at will.
+    servers = await cluster.refresh() # Get an updated list of servers on every node. This will check each time the command is run, so new servers can be added at will.
 
     if not input: # Check to see if there is any input. If the user ran the command without any arguments, this will evaluate to true.
         max_size = 0 # This contains the length of the longest server name
@@ -300,43 +1362,962 @@ async def run(ctx, *input):
             if mods:
                 msg += f'\n\t\tType: {mods}'
 
+            memory = server['memory']
+            if memory:
+                msg += f'\n\t\tMemory: {memory}'
+
             ip = server['ip']
             if ip:
                 msg += f'\n\t\tIP: {ip}'
 
+            if len(cluster.nodes) > 1: # Check if there is more than one node, in which case it is worth knowing which one has the server
+                msg += f'\n\t\tNode: {", ".join(node.name for node in cluster.locations[server["name"]])}'
+
         msg += '```'
 
         await ctx.send(msg) # Send the message
         return # Return so that we don't trigger any logic below (logic that assumes we have input)
 
     # Here we know that we have some input, because if we didn't control would have stopped at the return statement in the if above.
-    server_names = list(s['name'] for s in servers) # Build a list of server names. This is a shorthand foreach loop that just makes a list of the name value of each item in servers.
-    for server in input: # Loop through all of the inputted "servers"
-        if not isinstance(server, str): # Check to make sure the inputted server is a string. I think it always should be a string, but this will guarantee it for us.
-            await ctx.send(f'Input "{server}" is not a valid server. Ignoring.') # Send an error message if it isn't a string
-
-            continue # Continue so that we don't actually do anything with this malformed input
-
-        if server not in server_names: # Check to see if the server name is valid.
-            await ctx.send(f'Server "{server}" could not be found. Ignoring.') # Send an error message if the inputted server name is not found
-
-            continue # Continue so that we don't start a server that doesn't exist.
-
-        await ctx.send(f'Starting server "{server}"') # Send a log message to inform the user of the current status
-
-        try: # Try to start the server
-            start_server(server) # Actually start the server
-        except TypeError: # Catch if the inputted name is invalid for whatever reason
-            await ctx.send(f'There was an internal error starting server {server}. Please contact a server administrator.') # Send an error message to inform the user of the status
-        except ValueError: # Catch if the inputted name was not found
-            await ctx.send(f'The server {server} could not seem to be found. Try again later.') # Send an error message to inform the user of the status
-        except RuntimeError: # Catch if the server is already running.
-            await ctx.send(f'The server {server} is already running.') # Send an error message to inform the user of the status
-        except Exception: # Catch a general exception. This is here in case there was any extreneous error in the os functions.
-            print(f'Unknown error starting "{server}". Log:\n') # Print a status message to the console
+    names = list(dict.fromkeys(input)) # Remove any servers that were inputted more than once, keeping the order they were inputted in
+    status = StatusMessage(ctx, 'Starting servers:') # Create a single status message for all of the servers. This is edited as the servers start
+    for server in names: # Loop through all of the inputted "servers"
+        status.set(server, 'queued') # Every server starts out queued
+    await status.send() # Send the status message
+
+    await asyncio.gather(*(start_and_report(status, server) for server in names)) # Start all of the servers at the same time. How many actually start at once is limited by start_server
+    await status.close() # Make sure the status message shows the final state of every server
+
+async def start_and_report(status, server):
+    """Start a single server for the run command, and keep its line in the status message up to date.
+    The server is started on the node that has its files, or the least loaded one if several do. Once
+    it is started, this waits for the server to become ready, so that servers starting at the same
+    time don't have to compete with each other for as long."""
+    if server not in cluster.servers: # Check to see if the server name is valid. This is a lookup in the merged catalog, which was refreshed by the run command.
+        status.set(server, 'not found') # Update the status if the inputted server name is not found
+        return # Return so that we don't start a server that doesn't exist.
+
+    if server in cluster.running or server in supervisor.servers: # Check if the server is already running, so it doesn't wait in a queue for nothing
+        status.set(server, 'already running') # If so, update the status to inform the user of the status
+        return # Return, since the server was already ready before
+
+    node = await cluster.choose_node(server) # Choose the node to start the server on
+    where = f' on {node.name}' if len(cluster.nodes) > 1 else '' # Say which node the server is started on, if there is more than one
+
+    try: # Try to start the server
+        await node.call('start', name=server, timeout=node_start_timeout, on_admitted=lambda: status.set(server, f'starting{where}')) # Actually start the server. The node queues it until it fits, and updates the status once it is starting
+    except TypeError: # Catch if the inputted name is invalid for whatever reason
+        status.set(server, 'internal error, contact a server administrator') # Update the status to inform the user of the error
+        return # Return, since there is no server to wait for
+    except ValueError as ex: # Catch if the server was not found, or could never fit on the node
+        status.set(server, f'could not be started: {ex}') # Update the status to inform the user of the error
+        return # Return, since there is no server to wait for
+    except RuntimeError: # Catch if the server is already running.
+        status.set(server, 'already running') # Update the status to inform the user of the status
+        return # Return, since the server was already ready before
+    except Exception: # Catch a general exception. This is here in case there was any extreneous error in the os functions, or the node couldn't be reached.
+        print(f'Unknown error starting "{server}". Log:\n') # Print a status message to the console
+        traceback.print_exc() # Print the full stack trace
+        status.set(server, 'internal error, contact a server administrator') # Update the status to inform the user of the error
+        return # Return, since there is no server to wait for
+
+    status.set(server, f'started{where}, waiting until ready') # Update the status to inform the user of the current status
+
+    try: # Try to wait for the server to be ready
+        startup_time = await node.call('wait_ready', name=server, timeout=supervisor.ready_timeout + 30) # Wait for the server to be ready
+    except RuntimeError: # Catch if the server stopped before it was ready
+        status.set(server, f'stopped before it was ready, see {prefix}logs {server}' if node is cluster.nodes[0] else 'stopped before it was ready') # Update the status to inform the user of the error. Logs are only available for this node
+    except asyncio.TimeoutError: # Catch if the server took too long to become ready
+        status.set(server, 'running, but not ready in time') # Update the status to inform the user of the current status
+    except Exception: # Catch if the node couldn't be reached
+        print(f'Unknown error waiting for "{server}". Log:\n') # Print a status message to the console
+        traceback.print_exc() # Print the full stack trace
+        status.set(server, f'started{where}, but could not check if it is ready') # Update the status to inform the user of the current status
+    else: # If the server became ready
+        status.set(server, f'running{where}, ready in {startup_time:.1f}s') # Update the status to inform the user of the current status
+
+@commands.check_any(commands.has_role(f'{bot_role}'), commands.has_permissions(administrator=True)) # Only allow people to see startup times that have the role or are administrators
+@client.command(
+    name='startstats',
+    brief='Show how long servers take to start',
+    help='Show how long servers take to start. For each server that has been started by the bot, this '
+         'shows the median and 95th percentile of the time it took to become ready.',
+    description='Show startup time statistics of the servers.')
+async def startstats(ctx):
+    """Startup statistics command. This sends the median and 95th percentile of the recorded startup
+    times of each server, along with how many startup times they are based on."""
+    if not supervisor.startup_times: # Check if no startup times have been recorded yet
+        await ctx.send('No startup times have been recorded yet.') # If so, send a message to inform the user of the status
+        return # and stop
+
+    max_size = max(len(name) for name in supervisor.startup_times) # Get the length of the longest server name
+    msg = '```' # Begin the message string
+    msg += '{0:<{width}} {1:>8} {2:>8} {3:>6}'.format('Server', 'p50', 'p95', 'Starts', width=max_size) # Add a heading
+    for name in sorted(supervisor.startup_times): # Loop through each of the servers, in order of name
+        times = supervisor.startup_times[name] # Get the startup times of the server
+        p50 = f'{percentile(times, 50):.1f}s' # Get the median startup time
+        p95 = f'{percentile(times, 95):.1f}s' # Get the 95th percentile startup time
+        msg += '\n{0:<{width}} {1:>8} {2:>8} {3:>6}'.format(name, p50, p95, len(times), width=max_size) # Add the statistics of the server
+    msg += '```'
+
+    await ctx.send(msg) # Send the message
+
+@commands.check_any(commands.has_role(f'{bot_role}'), commands.has_permissions(administrator=True)) # Only allow people to see the bot's metrics that have the role or are administrators
+@client.command(
+    name='stats',
+    brief='Show where the bot spends its time',
+    help='Show where the bot spends its time. This shows how long commands and the steps of starting '
+         'servers take, how responsive the bot is, and how much CPU and memory each running server uses.',
+    description='Show the metrics of the bot.')
+async def stats(ctx):
+    """Stats command. This sends a summary of the metrics: the count, mean and estimated 95th
+    percentile of each histogram, the event loop lag, and the resource usage of each server."""
+    with metrics.lock: # Make sure nothing records metrics while they are summarized
+        histograms = sorted(metrics.histograms.items()) # Get every histogram, in order
+        gauges = dict(metrics.gauges) # Get every gauge
+
+    paginator = commands.Paginator(max_size=2000) # Create a paginator to split the metrics over messages, wrapped in code blocks
+    paginator.add_line('Timings (count, mean, p95):') # Add a heading for the histograms
+    for (name, labels), histogram in histograms: # Loop through each histogram
+        label = ','.join(str(value) for _, value in labels) # Format the labels of the histogram
+        name = f'{name}[{label}]' if label else name # Add them to the name
+        paginator.add_line(f'\t{name}: {histogram.count}, {histogram.sum / histogram.count * 1000:.1f}ms, <={histogram.quantile(0.95) * 1000:.0f}ms') # Add the summary of the histogram
+
+    paginator.add_line(f'Event loop lag: {loop_lag["last"] * 1000:.1f}ms (max {loop_lag["max"] * 1000:.1f}ms)') # Add the event loop lag
+
+    paginator.add_line('Servers (CPU, memory):') # Add a heading for the servers
+    for (name, labels), cpu in sorted(gauges.items()): # Loop through each gauge, in order
+        if name == 'server_cpu_percent': # Check if this is the CPU usage of a server
+            rss = gauges.get(('server_rss_bytes', labels), 0) # If so, get its memory too
+            paginator.add_line(f'\t{labels[0][1]}: {cpu:.0f}%, {rss / SIZE_UNITS["M"]:.0f}M') # Add the usage of the server
+
+    for page in paginator.pages: # Loop through each of the messages
+        await ctx.send(page) # Send the message
+
+@commands.check_any(commands.has_role(f'{bot_role}'), commands.has_permissions(administrator=True)) # Only allow people to see the start queue that have the role or are administrators
+@client.command(
+    name='queue',
+    brief='Show the servers waiting to start',
+    help='Show the servers waiting to start. Servers wait in the queue until there is enough memory '
+         'and CPU free on the host for them. This shows the servers that are starting, and the ones '
+         'that are waiting, with a rough estimate of how long they will wait.',
+    description='Show the start queue.')
+async def queue(ctx):
+    """Queue command. This sends the servers that are starting, and the servers that are waiting in
+    the start queue along with their estimated wait."""
+    if not start_queue.starting and not start_queue.pending: # Check if nothing is starting or waiting
+        await ctx.send('No servers are starting or waiting to start.') # If so, send a message to inform the user of the status
+        return # and stop
+
+    now = time.monotonic() # Get the current time
+    msg = '```' # Begin the message string
+    msg += 'Starting:' # Add a heading for the servers that are starting
+    for entry in start_queue.starting.values(): # Loop through the servers that are starting
+        msg += f'\n\t{entry.name} (for {now - entry.started:.0f}s)' # Add the server and how long it has been starting
+
+    msg += '\nWaiting:' # Add a heading for the servers that are waiting
+    for position, (entry, wait) in enumerate(start_queue.estimate(), start=1): # Loop through the servers that are waiting, in order
+        memory = f', needs {entry.memory / SIZE_UNITS["G"]:.1f}G' if entry.memory else '' # Describe how much memory the server needs, if it is known
+        msg += f'\n\t{position}. {entry.name} (waited {now - entry.queued:.0f}s, ~{wait:.0f}s left{memory})' # Add the server and its estimated wait
+    msg += '```'
+
+    await ctx.send(msg[:1997] + '```' if len(msg) > 2000 else msg) # Send the message, cut off if it is too long
+
+LOGS_MAX_MESSAGES = 5 # The most messages the logs command sends at once, to stay clear of Discord's rate limits
+
+@commands.check_any(commands.has_role(f'{bot_role}'), commands.has_permissions(administrator=True)) # Only allow people to see server output that have the role or are administrators
+@client.command(
+    name='logs',
+    brief='Show the console output of a server',
+    help='Show the console output of a server. The syntax is the command, then the name of a server, '
+         'then optionally the amount of lines to show, which defaults to 20. At most 5 messages are '
+         'sent, so long output is cut down to the newest lines that fit.',
+    description='Show the last lines of console output of a server.')
+async def logs(ctx, server, amount: int = 20):
+    """Logs command. This sends the last lines of console output of a server that was started by the
+    bot. The lines are split over as many messages as needed to stay under the message length limit,
+    up to LOGS_MAX_MESSAGES, so a big amount can't flood the channel. If the lines don't fit, the oldest
+    ones are left out, and the reply says so."""
+    log = supervisor.logs.get(server) # Look up the console output of the server
+    if not log: # Check if there is no console output for the server
+        await ctx.send(f'There is no console output for server "{server}".') # If so, send an error message...
+        return # and stop
+
+    lines = log.tail(max(amount, 1)) # Get the last lines of console output. At least one line is shown
+    if not lines: # Check if the server hasn't written anything yet
+        await ctx.send(f'Server "{server}" has not written any console output yet.') # If so, send a message to inform the user of the status
+        return # and stop
+
+    paginator = commands.Paginator(max_size=2000) # Create a paginator to split the lines over messages, wrapped in code blocks
+    for line in lines: # Loop through each of the lines
+        paginator.add_line(line.replace('```', '`\u200b`\u200b`')) # Add the line, with zero width spaces breaking up anything that would close the code block. Lines are short enough to always fit
+
+    pages = paginator.pages # Get the messages
+    if len(pages) > LOGS_MAX_MESSAGES: # Check if there are too many messages to send
+        pages = pages[-LOGS_MAX_MESSAGES:] # If so, only send the newest ones
+        shown = sum(page.count('\n') - 1 for page in pages) # Count the lines in them. Each line ends in a newline, and so does the opening of the code block
+        await ctx.send(f'Only the last {shown} of the {len(lines)} lines fit. Showing those.') # Send a message to inform the user that the output was cut short
+
+    for page in pages: # Loop through each of the messages
+        await ctx.send(page) # Send the message
+
+# --------------------------------------------------------------------------------------- #
+# ------------------------------ Server List Ping section ------------------------------- #
+# --------------------------------------------------------------------------------------- #
+
+def pack_varint(value):
+    """Encode a number as a VarInt, the variable length integer used by the Minecraft protocol. Each
+    byte holds seven bits of the number, and the top bit is set on every byte except the last."""
+    value &= 0xFFFFFFFF # Treat the number as an unsigned 32 bit number, so negative numbers are encoded like the protocol expects
+    data = b'' # The encoded number
+    while True: # Keep adding bytes until the whole number is encoded
+        byte = value & 0x7F # Get the lowest seven bits
+        value >>= 7 # Remove them from the number
+        if value: # Check if there is more of the number left
+            data += bytes([byte | 0x80]) # If so, add the byte with the top bit set
+        else:
+            return data + bytes([byte]) # Otherwise, add the last byte and return the encoded number
+
+async def read_varint(reader):
+    """Read a VarInt from a stream. If the VarInt is longer than five bytes, it is invalid, and a
+    ValueError is raised."""
+    value = 0 # The decoded number
+    for index in range(5): # A VarInt is at most five bytes long
+        byte = (await reader.readexactly(1))[0] # Read a byte
+        value |= (byte & 0x7F) << (7 * index) # Add its seven bits to the number
+        if not byte & 0x80: # Check if this was the last byte
+            return value # If so, return the number
+
+    raise ValueError('VarInt is too long') # If there were more than five bytes, the VarInt is invalid
+
+def pack_packet(packet_id, data=b''):
+    """Build a packet. A packet is its length, then its ID, then its data."""
+    body = pack_varint(packet_id) + data # Put the ID in front of the data
+    return pack_varint(len(body)) + body # Put the length in front of it all
+
+def flatten_motd(description):
+    """Turn the description from a status response into plain text. The description can be a plain
+    string or a chat component, which has text and a list of extra components. Formatting codes are
+    removed."""
+    if isinstance(description, dict): # Check if the description is a chat component
+        text = description.get('text', '') + ''.join(flatten_motd(extra) for extra in description.get('extra', [])) # If so, join its text with the text of its extra components
+    else:
+        text = str(description or '') # Otherwise, it is just text
+
+    return re.sub('\u00a7.', '', text) # Remove any formatting codes
+
+async def ping_server(host, port, timeout=3.0):
+    """Ping a server with the Server List Ping protocol. This does the handshake, asks for the status,
+    then sends a ping and times how long the pong takes. It returns a dictionary with the players
+    online, the maximum players, the MOTD, the version and the latency in milliseconds. If the
+    server doesn't respond in time or sends something invalid, an exception is raised."""
+    async def ping():
+        """Do the actual ping, so the whole exchange can be given a single timeout."""
+        reader, writer = await asyncio.open_connection(host, port) # Connect to the server
+        try: # Make sure the connection is closed when done
+            handshake = pack_varint(-1) + pack_varint(len(host.encode())) + host.encode() + struct.pack('>H', port) + pack_varint(1) # Build a handshake with an unknown protocol version, asking for the status
+            writer.write(pack_packet(0x00, handshake) + pack_packet(0x00)) # Send the handshake and the status request
+            await writer.drain() # Wait for them to be sent
+
+            await read_varint(reader) # Read the length of the response
+            if await read_varint(reader) != 0x00: # Read the ID of the response, and check that it is a status response
+                raise ValueError('Unexpected packet in response to the status request') # If not, raise a value error
+            status = json.loads(await reader.readexactly(await read_varint(reader))) # Read the status, which is a JSON string
+
+            sent = time.monotonic() # Get the time the ping is sent at
+            writer.write(pack_packet(0x01, struct.pack('>q', 0))) # Send a ping
+            await writer.drain() # Wait for it to be sent
+            await read_varint(reader) # Read the length of the pong
+            if await read_varint(reader) != 0x01: # Read the ID of the pong, and check that it is actually a pong
+                raise ValueError('Unexpected packet in response to the ping') # If not, raise a value error
+            await reader.readexactly(8) # Read the rest of the pong
+            latency = (time.monotonic() - sent) * 1000 # Figure out how long the pong took, in milliseconds
+        finally:
+            writer.close() # Close the connection
+
+        players = status.get('players', {}) # Get the player information
+        return { # Return the interesting parts of the status
+            'online': players.get('online', 0),
+            'max': players.get('max', 0),
+            'motd': flatten_motd(status.get('description')),
+            'version': status.get('version', {}).get('name'),
+            'latency': latency,
+        }
+
+    return await asyncio.wait_for(ping(), timeout) # Ping the server, giving up if it takes too long
+
+class StatusCache:
+    """A cache of the status of every server. The status of all of the servers is checked at the
+    same time, and kept for a short while, so that several people checking the status around the same
+    time only cause the servers to be pinged once. If a check is already running when the status is
+    asked for, the result of that check is waited for instead of starting another one."""
+
+    def __init__(self, ttl=10.0, timeout=3.0):
+        """Initialize the variables. The cache starts out empty."""
+        self.ttl = ttl # How long the status is kept for, in seconds
+        self.timeout = timeout # How long to wait for each server to respond, in seconds
+        self.statuses = None # The last checked status of every server
+        self.checked = None # The time the status was last checked at
+        self.check = None # The task checking the status, while a check is running
+
+    async def get(self):
+        """Get the status of every server. The cached status is returned if it is recent enough.
+        Otherwise, the status is checked again, or the check that is already running is waited for."""
+        if self.checked is not None and time.monotonic() - self.checked < self.ttl: # Check if the cached status is recent enough
+            return self.statuses # If so, return it
+
+        if not self.check: # Check if there is no check running yet
+            self.check = asyncio.ensure_future(self.refresh()) # If so, start one
+        return await asyncio.shield(self.check) # Wait for the check. It is shielded, so one caller giving up doesn't cancel it for the others
+
+    async def refresh(self):
+        """Check the status of every server with an address in its metadata, all at the same time. The
+        result is a list of each server's name and its status, which is a dictionary, None if the server
+        has no address, or the exception if the server didn't respond."""
+        try: # Make sure the check is cleared when done
+            servers = await cluster.refresh() # Get an updated list of servers on every node
+            addresses = [(server['name'], parse_address(server['ip'])) for server in servers] # Get the address of each server
+            results = await asyncio.gather(*(ping_server(*address, timeout=self.timeout) for _, address in addresses if address), return_exceptions=True) # Ping every server with an address at the same time
+
+            results = iter(results) # Go through the results in order
+            self.statuses = [(name, next(results) if address else None) for name, address in addresses] # Match the results up with the servers
+            self.checked = time.monotonic() # Store the time the status was checked at
+            return self.statuses # Return the status of every server
+        finally:
+            self.check = None # The check is done
+
+status_cache = StatusCache(config.getfloat('DEFAULT', 'status_ttl', fallback=10.0), config.getfloat('DEFAULT', 'status_timeout', fallback=3.0)) # Create the status cache
+
+@commands.check_any(commands.has_role(f'{bot_role}'), commands.has_permissions(administrator=True)) # Only allow people to see the server status that have the role or are administrators
+@client.command(
+    name='status',
+    brief='Show which servers are online',
+    help='Show which servers are online. For every server with an ip in its metadata, this shows '
+         'whether it is online, how many players are on it, its MOTD and its latency.',
+    description='Show the status of the servers.')
+async def status(ctx):
+    """Status command. This pings every server with an address, and sends whether it is online, its
+    players, MOTD and latency. The status is cached for a short while, so running the command often
+    doesn't ping the servers more often."""
+    statuses = await status_cache.get() # Get the status of every server
+    if not statuses: # Check if there are no servers
+        await ctx.send('There are no servers.') # If so, send a message to inform the user of the status
+        return # and stop
+
+    paginator = commands.Paginator(max_size=2000) # Create a paginator to split the statuses over messages, wrapped in code blocks
+    for name, info in statuses: # Loop through each of the servers
+        if info is None: # Check if the server has no address
+            paginator.add_line(f'{name}: unknown (no ip in metadata)') # If so, its status can't be checked
+        elif isinstance(info, Exception): # Check if the server didn't respond
+            paginator.add_line(f'{name}: offline') # If so, it is offline
+        else:
+            paginator.add_line(f'{name}: online, {info["online"]}/{info["max"]} players, {info["latency"]:.0f}ms') # Add the players and the latency
+            if info['motd']: # Check if the server has a MOTD
+                motd = ' '.join(info['motd'].split())[:200] # If so, put it on a single line, cut off so a long one can't take up the whole message...
+                paginator.add_line('\t' + motd.replace('```', '`\u200b`\u200b`')) # and add it, with anything that would close the code block broken up
+
+    for page in paginator.pages: # Loop through each of the messages
+        await ctx.send(page) # Send the message
+
+# --------------------------------------------------------------------------------------- #
+# ------------------------------------ RCON section ------------------------------------- #
+# --------------------------------------------------------------------------------------- #
+
+RCON_AUTH = 3 # The type of an RCON login packet
+RCON_COMMAND = 2 # The type of an RCON command packet, and of the response to a login
+RCON_MARKER = 200 # An unknown packet type. The server answers it with a single packet, which marks the end of the response to a command before it
+
+def read_properties(file):
+    """Read a server.properties file into a dictionary. Each line is a key and a value separated by
+    an equals sign, and lines starting with a # are comments."""
+    properties = {} # The properties in the file
+    with open(file, encoding='utf-8', errors='replace') as properties_file: # Open the file
+        for line in properties_file: # Loop through each line
+            line = line.strip() # Remove any surrounding whitespace
+            if not line or line.startswith(('#', '!')): # Check if the line is empty or a comment
+                continue # If so, skip it
+
+            key, _, value = line.partition('=') # Split the key and the value
+            properties[key.strip()] = value.strip() # Store the property
+
+    return properties # Return the properties
+
+def get_rcon_settings(name):
+    """Get the address and password to connect to a server with RCON. These come from the server's
+    server.properties file. RCON is reached on the server-ip of the server if it is set, and on
+    localhost otherwise. If the server can't be found or doesn't have RCON enabled with a password,
+    a ValueError is raised."""
+    catalog.refresh() # Make sure the catalog is up to date
+    if not catalog.get(name): # Check if the server exists
+        raise ValueError('The server could not be found') # If not, raise a value error
+
+    try: # Try to read the properties of the server
+        properties = read_properties(path.join(server_dir, name, 'server.properties')) # Read the properties of the server
+    except FileNotFoundError: # Catch if the server doesn't have a server.properties file yet
+        raise ValueError('The server has no server.properties') from None # If so, raise a value error
+
+    if properties.get('enable-rcon', 'false').lower() != 'true' or not properties.get('rcon.password'): # Check if RCON is enabled with a password
+        raise ValueError('RCON is not enabled for the server') # If not, raise a value error
+
+    host = properties.get('server-ip') # Get the address the server listens on. RCON listens on the same one
+    if not host or host in ('0.0.0.0', '::'): # Check if the server listens on every address
+        host = '127.0.0.1' # If so, reach RCON locally, since servers run on this host
+    return host, int(properties.get('rcon.port') or 25575), properties['rcon.password'] # Return the address and the password
+
+class RconConnection:
+    """A single authenticated RCON connection to a server. Commands sent over it are sent one at a
+    time, and the connection is kept open to be used again."""
+
+    def __init__(self, host, port, password):
+        """Initialize the variables. The connection isn't opened until connect is called."""
+        self.host = host # Store the host of the server
+        self.port = port # Store the RCON port of the server
+        self.password = password # Store the RCON password of the server
+        self.reader = None # The stream to read from the server
+        self.writer = None # The stream to write to the server
+        self.next_id = 0 # The ID of the next packet to send
+        self.lock = asyncio.Lock() # A lock, so that only one command is sent at a time
+        self.used = time.monotonic() # The time the connection was last used at
+
+    @property
+    def closed(self):
+        """Whether the connection is closed, or has been closed by the server."""
+        return not self.writer or self.writer.is_closing() or self.reader.at_eof() # The connection is closed if it was never opened, is closing, or the server has closed it
+
+    def send(self, type, payload):
+        """Send a packet, and return its ID."""
+        self.next_id += 1 # Get a new ID for the packet
+        data = struct.pack('<ii', self.next_id, type) + payload.encode('utf-8') + b'\x00\x00' # Build the packet: its ID, its type, its payload and two null bytes
+        self.writer.write(struct.pack('<i', len(data)) + data) # Send the packet, with its length in front
+        return self.next_id # Return the ID of the packet
+
+    async def read(self):
+        """Read a packet, and return its ID, type and payload."""
+        length, = struct.unpack('<i', await self.reader.readexactly(4)) # Read the length of the packet
+        data = await self.reader.readexactly(length) # Read the rest of the packet
+        request_id, type = struct.unpack('<ii', data[:8]) # Get the ID and the type of the packet
+        return request_id, type, data[8:-2].decode('utf-8', errors='replace') # Return the ID, type and payload of the packet
+
+    async def connect(self, timeout=5.0):
+        """Open the connection and log in. If the password is wrong, a PermissionError is raised."""
+        async def connect():
+            """Do the actual connecting, so it can be given a single timeout."""
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port) # Connect to the server
+            sock = self.writer.get_extra_info('socket') # Get the socket of the connection
+            if sock: # Check if there is a socket
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) # If so, turn on TCP keep-alive, so a dead connection is noticed
+
+            self.send(RCON_AUTH, self.password) # Log in
+            while True: # Keep reading until the response to the login
+                request_id, type, _ = await self.read() # Read a packet
+                if type == RCON_COMMAND: # Check if this is the response to the login
+                    if request_id == -1: # Check if the login failed
+                        raise PermissionError('The RCON password is wrong') # If so, raise a permission error
+                    return # Otherwise, the connection is logged in
+
+        try: # Try to connect
+            await asyncio.wait_for(connect(), timeout) # Connect, giving up if it takes too long
+        except BaseException: # Catch anything going wrong, including cancellation
+            self.close() # Close the connection, so it isn't left half open
+            raise # Re-raise the error
+
+    async def command(self, command, timeout=5.0):
+        """Send a command and return the response. A long response can be split over several packets,
+        so an unknown packet is sent right after the command. The server answers them in order, so
+        once the answer to the unknown packet arrives, the whole response has been read."""
+        async with self.lock: # Make sure only one command is sent at a time
+            self.used = time.monotonic() # Store the time the connection was used at
+            try: # Try to send the command
+                command_id = self.send(RCON_COMMAND, command) # Send the command
+                marker_id = self.send(RCON_MARKER, '') # Send the unknown packet to mark the end of the response
+
+                async def read_response():
+                    """Read the response, so it can be given a single timeout."""
+                    response = '' # The response to the command
+                    while True: # Keep reading until the answer to the unknown packet
+                        request_id, _, payload = await self.read() # Read a packet
+                        if request_id == marker_id: # Check if this is the answer to the unknown packet
+                            return response # If so, the response is complete
+                        if request_id == command_id: # Check if this is part of the response to the command
+                            response += payload # If so, add it to the response
+
+                return await asyncio.wait_for(read_response(), timeout) # Read the response, giving up if it takes too long
+            except BaseException: # Catch anything going wrong. The connection could be in the middle of a response, so it can't be used again
+                self.close() # Close the connection
+                raise # Re-raise the error
+
+    def close(self):
+        """Close the connection."""
+        if self.writer: # Check if the connection was opened
+            self.writer.close() # If so, close it
+
+class RconPool:
+    """A pool of RCON connections, one for each server. Connections are opened and logged in the first
+    time a command is sent to a server, and then kept open and used again for later commands, instead
+    of connecting and logging in for every command. A connection that has broken is opened again, and
+    connections that haven't been used for a while are closed."""
+
+    def __init__(self, timeout=5.0, idle_timeout=300.0):
+        """Initialize the variables. The pool starts out empty."""
+        self.timeout = timeout # How long to wait for a server to connect or respond, in seconds
+        self.idle_timeout = idle_timeout # How long a connection can go unused before it is closed, in seconds
+        self.connections = {} # A dictionary of server names to their connections
+        self.locks = {} # A dictionary of server names to locks, so that only one connection to a server is opened at a time
+        self.reaper = None # The task closing idle connections, while there are any connections
+
+    async def get(self, name):
+        """Get a logged in connection to a server, opening one if there isn't one that is still open.
+        Opening a connection holds a lock for the server, so that commands sent at the same time share
+        one connection instead of each opening their own."""
+        lock = self.locks.setdefault(name, asyncio.Lock()) # Get the lock for the server, creating it if it doesn't exist yet
+        async with lock: # Make sure nothing else opens a connection to the server at the same time
+            connection = self.connections.get(name) # Look up the connection to the server
+            if connection and not connection.closed: # Check if there is a connection that is still open
+                return connection # If so, use it
+
+            host, port, password = await run_blocking(get_rcon_settings, name) # Get the RCON settings of the server in the worker pool
+            connection = RconConnection(host, port, password) # Create the connection
+            await connection.connect(self.timeout) # Connect and log in
+            self.connections[name] = connection # Add the connection to the pool
+
+        if not self.reaper: # Check if idle connections aren't being closed yet
+            self.reaper = asyncio.create_task(self.reap()) # If so, start closing them
+        return connection # Return the connection
+
+    async def command(self, name, command, retry=True):
+        """Send a command to a server and return the response. If a connection from the pool turns out
+        to be broken, it is opened again and the command is sent once more, unless retry is False. That
+        should be used for commands that shouldn't possibly be run twice."""
+        reused = name in self.connections and not self.connections[name].closed # Check if there is a connection to use again
+        connection = await self.get(name) # Get a connection to the server
+        try: # Try to send the command
+            return await connection.command(command, self.timeout) # Send the command
+        except (OSError, EOFError): # Catch if the connection is broken
+            if self.connections.get(name) is connection: # Check if the broken connection is still in the pool, and hasn't been replaced by another command already
+                del self.connections[name] # If so, remove it from the pool
+            if not reused or not retry: # Check if the connection was new, or the command shouldn't be sent again
+                raise # If so, the server is really unreachable
+
+        return await (await self.get(name)).command(command, self.timeout) # Send the command again over a new connection
+
+    async def broadcast(self, names, command):
+        """Send a command to several servers at the same time, and return a list of each server's name
+        and its response, or the exception if it failed."""
+        results = await asyncio.gather(*(self.command(name, command) for name in names), return_exceptions=True) # Send the command to every server at the same time
+        return list(zip(names, results)) # Match the results up with the servers
+
+    def close(self, name):
+        """Close the connection to a server, if there is one."""
+        connection = self.connections.pop(name, None) # Remove the connection from the pool
+        if connection: # Check if there was a connection
+            connection.close() # If so, close it
+
+    async def reap(self):
+        """Close connections that haven't been used for a while, for as long as there are any."""
+        try: # Make sure the reaper is cleared when it stops
+            while self.connections: # Keep going while there are connections
+                await asyncio.sleep(self.idle_timeout / 2) # Wait before checking again
+                now = time.monotonic() # Get the current time
+                for name, connection in list(self.connections.items()): # Loop through each of the connections
+                    if connection.closed or now - connection.used > self.idle_timeout: # Check if the connection is closed or idle
+                        self.close(name) # If so, close it
+        finally:
+            self.reaper = None # Idle connections are no longer being closed
+
+rcon_pool = RconPool(config.getfloat('DEFAULT', 'rcon_timeout', fallback=5.0), config.getfloat('DEFAULT', 'rcon_idle_timeout', fallback=300.0)) # Create the RCON connection pool
+
+def describe_rcon_error(ex):
+    """Describe why sending a command over RCON failed, for a message to the user."""
+    if isinstance(ex, ValueError): # Check if RCON isn't set up for the server
+        return str(ex) # If so, the error already says why
+    if isinstance(ex, PermissionError): # Check if the password was wrong
+        return 'the RCON password in server.properties was not accepted' # If so, say so
+    if isinstance(ex, (OSError, EOFError, asyncio.TimeoutError)): # Check if the server couldn't be reached
+        return 'the server could not be reached. Is it running?' # If so, it is probably not running
+
+    return 'there was an internal error. Please contact a server administrator.' # Otherwise, something unexpected happened
+
+@commands.check_any(commands.has_role(f'{bot_role}'), commands.has_permissions(administrator=True)) # Only allow people to stop servers that have the role or are administrators
+@client.command(
+    name='stop',
+    brief='Stop a server',
+    help='Stop a server. The syntax is the command, then the name of the server. The server is asked '
+         'to stop over RCON, so it saves the world first. RCON has to be enabled in its server.properties.',
+    description='Stop a server.')
+async def stop(ctx, server):
+    """Stop command. This asks the node running the server to stop it over RCON, and to wait for it to
+    exit if it is supervising it."""
+    await cluster.refresh() # Get an updated list of servers, to find the node running the server
+    node = cluster.running.get(server) or next(iter(cluster.locations.get(server, [])), cluster.nodes[0]) # Use the node running the server, or else the first one that has it, or else this one
+
+    message = await ctx.send(f'Stopping server "{server}"...') # Send a log message to inform the user of the current status
+    try: # Try to stop the server
+        stopped = await node.call('stop', name=server, timeout=150) # Stop the server, and wait for it to exit
+    except Exception as ex: # Catch anything going wrong
+        if not isinstance(ex, (ValueError, PermissionError, OSError, EOFError, asyncio.TimeoutError)): # Check if this is an unexpected error
+            print(f'Unknown error stopping "{server}". Log:\n') # If so, print a status message to the console
             traceback.print_exc() # Print the full stack trace
-            await ctx.send(f'There was an internal error starting server {server}. Please contact a server administrator.') # Send an error message to inform the user of the status
-        else: # If the server started without throwing any sort of error
-            await ctx.send(f'Server "{server}" started') # Send a log message to inform the user of the current status. TODO: potentially don't send this? (it could be confused with meaning the server is actually started.)
+        await message.edit(content=f'Could not stop server "{server}": {describe_rcon_error(ex)}') # Edit the message to inform the user of the error
+        return # and stop
+
+    if stopped is False: # Check if the server didn't exit in time
+        await message.edit(content=f'Server "{server}" was told to stop, but is still running.') # If so, edit the message to inform the user of the status
+    elif stopped: # Check if the server exited
+        await message.edit(content=f'Server "{server}" stopped.') # If so, edit the message to inform the user of the status
+    else: # Otherwise, the server wasn't started by the bot, so it couldn't be waited for
+        await message.edit(content=f'Server "{server}" was sent the stop command.') # Edit the message to inform the user of the status
+
+def get_registered_process(name):
+    """Get the process of a server from the process registry. This is None if the server isn't
+    registered, or its process is no longer alive."""
+    pid = registry.get_pid(name) # Look up the process of the server in the process registry
+    if not pid: # Check if the server isn't running
+        return None # If so, there is no process
+
+    try: # Try to get the process
+        return psutil.Process(pid) # Get the process
+    except psutil.NoSuchProcess: # Catch if the process exited in the meantime
+        return None # If so, there is no process
+
+def wait_registered_process(name, process, timeout):
+    """Wait for the registered process of a server to exit, and remove it from the process registry
+    once it does. The process isn't a child of this one, so it can't be waited for from the event
+    loop, and this should be run in the worker pool. Returns whether the process exited in time."""
+    _, alive = psutil.wait_procs([process], timeout=timeout) # Wait for the process to exit
+    if alive: # Check if the process is still running
+        return False # If so, it didn't exit in time
+
+    registry.unregister(name, process.pid) # Remove the process from the process registry
+    return True # The process exited
+
+async def stop_server(name):
+    """Stop a server on this host. The stop command is sent over RCON, so the server saves before it
+    stops. If the bot is supervising the server, the supervisor is told it is meant to stop first, so
+    it isn't restarted as if it had crashed, and this waits for the server to exit. A server that isn't
+    supervised, like one that kept running while the bot was restarted, is waited for through its
+    process in the process registry. It returns True if the server exited, False if it is still running
+    after two minutes, and None if the bot doesn't know the process of the server, so it can't be
+    waited for. If the server can't be stopped, an exception is raised."""
+    supervised = supervisor.servers.get(name) # Look up the server in the supervisor
+    if supervised: # Check if the server is supervised
+        supervised.stopping = True # If so, make sure it isn't restarted when it exits
+        process = None # The supervisor is waited for instead of the process
+    else:
+        process = await run_blocking(get_registered_process, name) # Otherwise, get its process from the process registry, before it stops
+
+    try: # Try to stop the server
+        await rcon_pool.command(name, 'stop', retry=False) # Send the stop command. This is never sent twice
+    except EOFError: # Catch if the server closed the connection before responding, which it can do when stopping
+        pass # The server is stopping
+    except BaseException: # Catch anything else going wrong
+        if supervised: # Check if the server is supervised
+            supervised.stopping = False # If so, it isn't stopping after all
+        raise # Re-raise the error
+    finally:
+        rcon_pool.close(name) # The server is going away, so its connection isn't needed anymore
+
+    if process: # Check if the server isn't supervised, but its process is known
+        return await run_blocking(wait_registered_process, name, process, 120) # If so, wait for the process to exit in the worker pool
+    if not supervised: # Check if the server isn't supervised, and its process isn't known
+        return None # If so, it can't be waited for
+
+    try: # Try to wait for the server to exit
+        await asyncio.wait_for(asyncio.shield(supervised.task), timeout=120) # Wait for the server to exit
+    except asyncio.TimeoutError: # Catch if the server takes too long to exit
+        return False # If so, it is still running
+    return True # Otherwise, it stopped
+
+@commands.check_any(commands.has_role(f'{bot_role}'), commands.has_permissions(administrator=True)) # Only allow people to run server commands that have the role or are administrators
+@client.command(
+    name='cmd',
+    brief='Run a command on one or more servers',
+    help='Run a command on one or more servers. The syntax is the command, then the server, then the '
+         'command to run. Several servers can be separated by commas, and * runs the command on every '
+         'running server, for example: cmd * save-all. RCON has to be enabled in their server.properties.',
+    description='Run a server command over RCON.')
+async def cmd(ctx, target, *, command):
+    """Server command command. This sends a command to one or more servers over RCON, using pooled
+    connections, and sends back their responses. Commands sent to several servers are sent to all of
+    them at the same time."""
+    if target == '*': # Check if the command should be sent to every running server
+        names = sorted(set(registry.snapshot()) | set(supervisor.servers)) # If so, use every server that is running
+    else:
+        names = list(dict.fromkeys(name for name in target.split(',') if name)) # Otherwise, use the servers separated by commas, without duplicates
+
+    if not names: # Check if there are no servers to send the command to
+        await ctx.send('There are no servers to run the command on.') # If so, send a message to inform the user of the status
+        return # and stop
+
+    paginator = commands.Paginator(max_size=2000) # Create a paginator to split the responses over messages, wrapped in code blocks
+    for name, response in await rcon_pool.broadcast(names, command): # Send the command to the servers, and loop through their responses
+        if isinstance(response, BaseException): # Check if sending the command failed
+            if not isinstance(response, (ValueError, PermissionError, OSError, EOFError, asyncio.TimeoutError)): # Check if this is an unexpected error
+                print(f'Unknown error running a command on "{name}":') # If so, print a status message to the console
+                traceback.print_exception(type(response), response, response.__traceback__) # Print the full stack trace
+            response = f'Error: {describe_rcon_error(response)}' # Describe the error
+
+        lines = (response or '(no response)').replace('```', '`\u200b`\u200b`').splitlines() # Split the response into lines, with anything that would close the code block broken up
+        paginator.add_line(f'{name}: {lines[0][:1900]}') # Add the first line of the response after the name of the server
+        for line in lines[1:]: # Loop through the rest of the lines
+            paginator.add_line(f'\t{line[:1900]}') # Add the line, indented under the server
+
+    for page in paginator.pages: # Loop through each of the messages
+        await ctx.send(page) # Send the message
+
+# --------------------------------------------------------------------------------------- #
+# ---------------------------------- Multi-node section --------------------------------- #
+# --------------------------------------------------------------------------------------- #
 
-client.run(token)
+node_name = config.get('DEFAULT', 'node_name', fallback=None) # The name of this node, as shown to users. If it isn't set, the bot names an agent after its address, and itself after its host
+node_secret = config.get('DEFAULT', 'node_secret', fallback='') # The secret shared between the bot and its agents
+node_start_timeout = config.getfloat('DEFAULT', 'node_start_timeout', fallback=600.0) # How long to wait for a node to start a server, including its time in the node's queue, in seconds
+
+def get_memory_hint(server):
+    """Get the memory hint of a server, in bytes. If the server doesn't have one, or it isn't a valid
+    size, None is returned."""
+    if not server.get('memory'): # Check if the server has no memory hint in its metadata
+        return None # If so, there is nothing to parse
+
+    try: # Try to parse the memory hint
+        return parse_size(server['memory']) # Parse the memory hint
+    except ValueError: # Catch if the memory hint isn't a valid size
+        print(f'Invalid memory hint for "{server["name"]}". Ignoring.') # If so, print a message to the console...
+        return None # and start the server without it
+
+def get_node_load():
+    """Get how loaded this node is: its available memory minus the memory of servers that are still
+    starting, its total memory, its load per CPU, and how many servers are starting or waiting to."""
+    reserved = sum(start.memory or 0 for start in start_queue.starting.values()) # Add up the memory the servers that are still starting will use
+    memory = psutil.virtual_memory() # Get the memory of the node
+    return { # Return the load of the node
+        'available': memory.available - reserved,
+        'total': memory.total,
+        'load': psutil.getloadavg()[0] / (psutil.cpu_count() or 1),
+        'starting': len(start_queue.starting),
+        'pending': len(start_queue.pending),
+    }
+
+async def agent_catalog():
+    """Get the catalog of this node: its name, its servers and the servers that are running on it. The
+    name is None if it isn't set, in which case the bot keeps naming the node after its address."""
+    servers = await get_server_list_async() # Get an updated list of servers
+    return {'name': node_name, 'servers': servers, 'running': sorted(set(supervisor.servers) | set(registry.snapshot()))} # Return the catalog
+
+async def agent_load():
+    """Get the load of this node."""
+    return await run_blocking(get_node_load) # Get the load in the worker pool, since it reads from the OS
+
+async def agent_start(name, on_admitted=None):
+    """Start a server on this node. The server waits in the start queue until it fits on this node,
+    then is started. This returns once the server is started, but its place among the starting
+    servers is held until it is ready, just like when starting it from the run command. If given,
+    on_admitted is called when the server is let out of the queue."""
+    await run_blocking(catalog.refresh) # Make sure the catalog is up to date
+    server = catalog.get(name) # Look up the server
+    if not server: # Check if the server isn't on this node
+        raise ValueError('The server could not be found') # If so, raise a value error
+
+    memory = get_memory_hint(server) # Get the memory hint of the server
+    start_queue.check(memory) # Make sure the server could fit on this node at all
+
+    started = asyncio.get_running_loop().create_future() # Resolved once the server is started, or failed to start
+    async def start():
+        """Wait for a slot, start the server, and hold the slot until it is ready."""
+        async with start_queue.slot(name, memory): # Wait in the start queue until the server fits
+            if on_admitted: # Check if anything wants to know when the server is let out of the queue
+                on_admitted() # If so, tell it
+
+            try: # Try to start the server
+                await start_server(name) # Actually start the server
+            except BaseException as ex: # Catch anything going wrong
+                started.set_exception(ex) # Pass it on to whoever asked to start the server
+                return # and give up the slot
+
+            started.set_result(None) # The server is started
+            try: # Try to wait for the server to be ready, holding the slot until then
+                await supervisor.wait_ready(name) # Wait for the server to be ready
+            except (RuntimeError, asyncio.TimeoutError): # Catch if the server stopped or took too long
+                pass # Either way, it is no longer starting
+
+    run_in_background(start()) # Start the server in the background, so the slot outlives this call
+    await started # Wait for the server to be started
+
+async def agent_wait_ready(name):
+    """Wait for a server on this node to become ready, and return how long it took."""
+    return await supervisor.wait_ready(name) # Wait for the server to be ready
+
+async def agent_stop(name):
+    """Stop a server on this node."""
+    return await stop_server(name) # Stop the server
+
+AGENT_OPS = { # The operations a node can be asked to do
+    'catalog': agent_catalog,
+    'load': agent_load,
+    'start': agent_start,
+    'wait_ready': agent_wait_ready,
+    'stop': agent_stop,
+}
+
+AGENT_ERRORS = { # The exceptions that are passed from an agent to the bot, by name
+    'TypeError': TypeError,
+    'ValueError': ValueError,
+    'RuntimeError': RuntimeError,
+    'PermissionError': PermissionError,
+    'TimeoutError': asyncio.TimeoutError,
+    'ConnectionRefusedError': ConnectionRefusedError,
+    'ConnectionError': ConnectionError,
+    'OSError': OSError,
+    'IncompleteReadError': EOFError,
+    'EOFError': EOFError,
+}
+
+class LocalNode:
+    """The node the bot itself is running on. Operations are run directly, without going over the
+    network."""
+
+    def __init__(self):
+        """Initialize the variables."""
+        self.name = node_name or socket.gethostname() # The name of the node
+
+    async def call(self, op, timeout=None, **args):
+        """Run an operation on this node. The timeout is ignored, since nothing goes over the network."""
+        return await AGENT_OPS[op](**args) # Run the operation
+
+class RemoteNode:
+    """A node running an agent on another host, or in another directory on this one. Operations are
+    sent to the agent as a line of JSON, along with the shared secret, and the agent answers with a
+    line of JSON containing the result or the error. A new connection is used for each operation."""
+
+    def __init__(self, address, secret, timeout=5.0):
+        """Initialize the variables. The name of the node is its address until the agent says what its
+        name is."""
+        self.name = address # The name of the node
+        self.host, self.port = parse_address(address) # The host and port of the agent
+        self.secret = secret # The secret shared with the agent
+        self.timeout = timeout # How long to wait for the agent to connect and answer, in seconds
+
+    async def call(self, op, timeout=None, **args):
+        """Run an operation on the node, and return its result. Callbacks can't be sent to another
+        host, so they are left out. If the operation failed on the node, the same kind of exception is
+        raised here. If the timeout is None, the node's default timeout is used."""
+        args = {key: value for key, value in args.items() if not callable(value)} # Leave out any callbacks
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port, limit=2 ** 24), self.timeout) # Connect to the agent. The limit allows for big catalogs
+        try: # Make sure the connection is closed when done
+            writer.write(json.dumps({'secret': self.secret, 'op': op, 'args': args}).encode() + b'\n') # Send the operation
+            await writer.drain() # Wait for it to be sent
+            line = await asyncio.wait_for(reader.readline(), timeout or self.timeout) # Wait for the answer
+        finally:
+            writer.close() # Close the connection
+
+        if not line: # Check if the agent closed the connection without answering
+            raise ConnectionError(f'Node {self.name} closed the connection') # If so, raise a connection error
+
+        response = json.loads(line) # Parse the answer
+        if response.get('ok'): # Check if the operation succeeded
+            return response.get('result') # If so, return its result
+
+        raise AGENT_ERRORS.get(response.get('type'), Exception)(response.get('error')) # Otherwise, raise the same kind of exception the agent did
+
+class Cluster:
+    """All of the nodes servers can run on. The catalogs of every node are merged, so the bot knows
+    every server, which nodes have its files, and which node is running it. When a server is started,
+    it is placed on the node that has its files, or the least loaded node if several do."""
+
+    def __init__(self, nodes):
+        """Initialize the variables. The first node should be the node the bot is running on."""
+        self.nodes = nodes # The nodes
+        self.servers = {} # A dictionary of server names to the servers, from the last refresh
+        self.locations = {} # A dictionary of server names to the nodes that have their files
+        self.running = {} # A dictionary of server names to the node running them
+
+    async def refresh(self):
+        """Get the catalog of every node at the same time and merge them. Nodes that can't be reached
+        are left out. This returns the merged list of servers, sorted by name."""
+        results = await asyncio.gather(*(node.call('catalog') for node in self.nodes), return_exceptions=True) # Get the catalog of every node
+
+        servers, locations, running = {}, {}, {} # The merged catalog
+        for node, result in zip(self.nodes, results): # Loop through each node's catalog
+            if isinstance(result, BaseException): # Check if the node couldn't be reached
+                print(f'Could not get the catalog of node {node.name}: {result!r}') # If so, print a message to the console...
+                continue # and leave it out
+
+            node.name = result['name'] or node.name # Use the name the node gave itself, if it has one
+            for server in result['servers']: # Loop through each server on the node
+                servers.setdefault(server['name'], server) # Add the server, if no other node has it
+                locations.setdefault(server['name'], []).append(node) # Remember that the node has the server's files
+            for name in result['running']: # Loop through each server running on the node
+                running.setdefault(name, node) # Remember which node is running it
+
+        self.servers, self.locations, self.running = servers, locations, running # Replace the merged catalog
+        return [servers[name] for name in sorted(servers)] # Return the servers, sorted by name
+
+    async def choose_node(self, name):
+        """Choose the node to start a server on. Only nodes with the server's files can start it. If
+        several do, their load is checked, and the one with the most room is chosen: nodes that have
+        enough memory for the server come first, then the lowest load per CPU, fraction of memory in
+        use, and amount of servers starting or waiting."""
+        nodes = self.locations.get(name, []) # Get the nodes that have the server's files
+        if len(nodes) <= 1: # Check if there is no choice to make
+            return nodes[0] if nodes else self.nodes[0] # If so, use the only node, or this one if none do
+
+        memory = get_memory_hint(self.servers[name]) or 0 # Get the memory the server needs
+        loads = await asyncio.gather(*(node.call('load') for node in nodes), return_exceptions=True) # Get the load of each node at the same time
+
+        def score(load):
+            """Score the load of a node. Lower is better."""
+            return (load['available'] < memory, load['load'] + 1 - load['available'] / load['total'] + load['starting'] + load['pending']) # Nodes without room for the server come last, then the least loaded first
+
+        candidates = [(score(load), index) for index, load in enumerate(loads) if not isinstance(load, BaseException)] # Score every node that could be reached
+        return nodes[min(candidates)[1]] if candidates else nodes[0] # Return the best node, or the first one if none could be reached
+
+cluster = Cluster([LocalNode()] + [RemoteNode(address.strip(), node_secret, config.getfloat('DEFAULT', 'node_timeout', fallback=5.0)) for address in config.get('DEFAULT', 'nodes', fallback='').split(',') if address.strip()]) # Create the cluster of this node and every configured agent
+
+async def handle_agent_request(reader, writer):
+    """Answer a single operation from the bot. The request is a line of JSON with the shared secret,
+    the operation and its arguments. The answer is a line of JSON with the result, or the type and
+    message of the exception if it failed."""
+    try: # Make sure the connection is closed when done
+        try: # Try to run the operation
+            request = json.loads(await asyncio.wait_for(reader.readline(), timeout=10)) # Read and parse the request
+            if not hmac.compare_digest(str(request.get('secret', '')).encode(), node_secret.encode()): # Check if the secret is wrong
+                raise PermissionError('The node secret is wrong') # If so, raise a permission error
+            if request.get('op') not in AGENT_OPS: # Check if the operation is unknown
+                raise ValueError(f'Unknown operation {request.get("op")!r}') # If so, raise a value error
+
+            response = {'ok': True, 'result': await AGENT_OPS[request['op']](**request.get('args', {}))} # Run the operation
+        except Exception as ex: # Catch anything going wrong, to pass it on to the bot
+            if type(ex).__name__ not in AGENT_ERRORS: # Check if this is an unexpected error
+                print('Unknown error running an operation from the bot. Log:\n') # If so, print a status message to the console
+                traceback.print_exc() # Print the full stack trace
+            response = {'ok': False, 'type': type(ex).__name__, 'error': str(ex)} # Describe the error
+
+        writer.write(json.dumps(response).encode() + b'\n') # Send the answer
+        await writer.drain() # Wait for it to be sent
+    except OSError: # Catch if the bot went away
+        pass # If so, there is nobody to answer
+    finally:
+        writer.close() # Close the connection
+
+async def run_agent():
+    """Run this node as an agent. Instead of connecting to Discord, the node waits for operations from
+    the bot, and supervises the servers it is asked to start."""
+    use_pidfd_child_watcher() # Wait for servers from the event loop, instead of from a thread per server
+    run_in_background(monitor_loop_lag(threshold=config.getfloat('DEFAULT', 'loop_lag_warning', fallback=0.25))) # Start monitoring the event loop
+    run_in_background(sample_resources(config.getfloat('DEFAULT', 'metrics_interval', fallback=15.0))) # Start sampling the resources used by the servers
+
+    metrics_port = config.getint('DEFAULT', 'metrics_port', fallback=None) # Get the port to serve the metrics on, if any
+    if metrics_port: # Check if the metrics should be served
+        await asyncio.start_server(serve_metrics, '127.0.0.1', metrics_port) # If so, start serving them on localhost
+
+    host = config.get('DEFAULT', 'agent_host', fallback='0.0.0.0') # Get the address to listen on
+    port = config.getint('DEFAULT', 'agent_port', fallback=25580) # Get the port to listen on
+    agent = await asyncio.start_server(handle_agent_request, host, port) # Start listening for operations from the bot
+    print(f'Agent {node_name or socket.gethostname()} listening on {host}:{port}') # Print a message to the console to inform of the current status
+    async with agent: # Make sure the agent is closed when done
+        await agent.serve_forever() # Answer operations until the agent is stopped
+
+if __name__ == '__main__': # Only run when started as a script, so that the benchmarks can import the bot without connecting to Discord
+    if agent_mode: # Check if this node should run as an agent
+        asyncio.run(run_agent()) # If so, run the agent
+    else:
+        client.run(token) # Otherwise, run the bot
@@ -0,0 +1,272 @@
+"""Helpers for the tests and the benchmarks. This loads fresh copies of the bot against temporary
+server directories, without connecting to Discord, and has fake Minecraft servers that speak the
+protocols the bot uses.
+The fake servers encode their packets on their own, instead of with the functions of the bot, so the
+tests catch mistakes in the bot's protocol code instead of repeating them."""
+
+# Import
+import asyncio
+import importlib.util
+import json
+import os
+from os import path
+import shutil
+import struct
+import tempfile
+
+dir_path = path.dirname(path.dirname(path.realpath(__file__))) # Get the full path of the directory that main.py is contained in
+
+START_FILE = 'run.bat' if os.name == 'nt' else 'run.sh' # The start file of the servers in the tests
+
+def load_bot_copy(work_dir, server_dir, module_name='bot', **options):
+    """Load a fresh copy of the bot for a server directory. The bot reads config.ini from the directory
+    main.py is in, so main.py is copied into the work directory, next to a generated config. Any
+    options are added to the config. The token is never used, since loading the bot doesn't connect to
+    Discord. The worker pool of the bot has to be shut down by the caller."""
+    shutil.copy(path.join(dir_path, 'main.py'), work_dir) # Copy the bot
+    options = {'server_dir': server_dir, 'token': 'test', 'pid_file': path.join(work_dir, 'pids.json'), 'priority': 'normal', **options} # The config of the bot
+    with open(path.join(work_dir, 'config.ini'), 'w') as file: # Generate the config
+        file.write('[DEFAULT]\n' + ''.join(f'{key} = {value}\n' for key, value in options.items()))
+
+    spec = importlib.util.spec_from_file_location(module_name, path.join(work_dir, 'main.py')) # Load the copy as a module of its own, so every copy is a fresh bot
+    bot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bot)
+    return bot # Return the bot
+
+def load_bot(test, server_dir, **options):
+    """Load a fresh copy of the bot for a server directory in a test, with load_bot_copy. The copy is
+    put in a temporary directory, which is removed when the test is done, and the worker pool of the
+    bot is shut down then too."""
+    work_dir = tempfile.mkdtemp() # Create a directory for the bot
+    test.addCleanup(shutil.rmtree, work_dir, ignore_errors=True) # Remove it when the test is done
+
+    bot = load_bot_copy(work_dir, server_dir, **options) # Load the bot
+    test.addCleanup(bot.executor.shutdown) # Shut down the worker pool of the bot when the test is done
+    return bot # Return the bot
+
+def make_server_dir(test):
+    """Create an empty server directory, which is removed when the test is done."""
+    server_dir = tempfile.mkdtemp() # Create the server directory
+    test.addCleanup(shutil.rmtree, server_dir, ignore_errors=True) # Remove it when the test is done
+    return server_dir # Return the server directory
+
+def make_server(server_dir, name, script='', metadata=None, properties=None):
+    """Create a server in a server directory, with a start file running the script. The metadata and
+    properties are dictionaries, written to metadata.ini and server.properties if they are given."""
+    dir = path.join(server_dir, name) # Construct a path to the server
+    os.mkdir(dir) # Create the server
+    with open(path.join(dir, START_FILE), 'w') as file: # Create the start file
+        file.write(script)
+
+    if metadata: # Check if the server should have metadata
+        with open(path.join(dir, 'metadata.ini'), 'w') as file: # If so, write it
+            file.write('[server]\n' + ''.join(f'{key} = {value}\n' for key, value in metadata.items()))
+    if properties: # Check if the server should have properties
+        with open(path.join(dir, 'server.properties'), 'w') as file: # If so, write them
+            file.write('#Minecraft server properties\n' + ''.join(f'{key}={value}\n' for key, value in properties.items()))
+
+class StubMessage:
+    """A stand-in for a Discord message. Edits only replace the content."""
+
+    def __init__(self, content):
+        """Initialize the variables."""
+        self.content = content # The content of the message
+
+    async def edit(self, content=None, **kwargs):
+        """Edit the message."""
+        self.content = content # Replace the content
+
+class StubContext:
+    """A stand-in for the context of a command. Messages are kept instead of sent, or if keep isn't
+    set, only counted, so that running a command over and over doesn't use more and more memory."""
+
+    def __init__(self, keep=True):
+        """Initialize the variables."""
+        self.keep = keep # Whether to keep the messages that were sent
+        self.messages = [] # The messages that were sent, if they are kept
+        self.sent = 0 # The amount of messages sent
+
+    async def send(self, content=None, **kwargs):
+        """Send a message."""
+        message = StubMessage(content) # Create the message
+        self.sent += 1 # Count it
+        if self.keep: # Check if messages are kept
+            self.messages.append(message) # If so, keep it
+        return message # Return the message, so it can be edited
+
+def encode_varint(value):
+    """Encode a number as a VarInt of the Minecraft protocol."""
+    value &= 0xFFFFFFFF # Negative numbers are encoded as unsigned 32 bit numbers
+    data = bytearray() # The encoded number
+    while value > 0x7F: # Keep going while there is more than seven bits left
+        data.append(value & 0x7F | 0x80) # Add seven bits, with the top bit saying more follows
+        value >>= 7
+    data.append(value) # Add the last seven bits
+    return bytes(data) # Return the encoded number
+
+async def decode_varint(reader):
+    """Read a VarInt of the Minecraft protocol from a stream."""
+    value = shift = 0 # The decoded number, and how far to shift the next seven bits
+    while True: # Keep reading until the last byte
+        byte = (await reader.readexactly(1))[0] # Read a byte
+        value |= (byte & 0x7F) << shift # Add its seven bits
+        shift += 7
+        if not byte & 0x80: # Check if this was the last byte
+            return value # If so, return the number
+
+class FakeSlpServer:
+    """A fake Minecraft server that answers the Server List Ping. It sends the status it is given, and
+    answers pings with pongs. If chunk is set, everything is written that many bytes at a time, to
+    check that the bot doesn't rely on a packet arriving in one piece. If silent is set, it never
+    answers at all."""
+
+    def __init__(self, status, chunk=None, silent=False):
+        """Initialize the variables. The server isn't listening until start is called."""
+        self.status = status # The status to send
+        self.chunk = chunk # How many bytes to write at a time, or None to write everything at once
+        self.silent = silent # Whether to never answer
+        self.connections = 0 # The amount of connections accepted
+        self.handshakes = [] # The handshakes that were received, as tuples of the protocol version, host, port and next state
+        self.server = None # The listening server
+        self.port = None # The port the server is listening on
+
+    async def start(self):
+        """Start listening on a free port on localhost."""
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0) # Start listening
+        self.port = self.server.sockets[0].getsockname()[1] # Get the port that was picked
+
+    async def close(self):
+        """Stop listening."""
+        self.server.close() # Stop listening
+        await self.server.wait_closed() # Wait until it has stopped
+
+    async def read_packet(self, reader):
+        """Read a packet, and return its ID and data."""
+        data = await reader.readexactly(await decode_varint(reader)) # Read the packet
+        stream = asyncio.StreamReader() # Put it in a stream, to decode the ID
+        stream.feed_data(data)
+        stream.feed_eof()
+        packet_id = await decode_varint(stream) # Decode the ID
+        return packet_id, await stream.read() # Return the ID and the rest of the packet
+
+    async def write_packet(self, writer, packet_id, data):
+        """Write a packet, in chunks if chunk is set."""
+        body = encode_varint(packet_id) + data # Put the ID in front of the data
+        packet = encode_varint(len(body)) + body # Put the length in front of it all
+        step = self.chunk or len(packet) # Get how many bytes to write at a time
+        for start in range(0, len(packet), step): # Loop through each chunk
+            writer.write(packet[start:start + step]) # Write it
+            await writer.drain() # Wait for it to be sent
+            if self.chunk: # Check if the packet is written in chunks
+                await asyncio.sleep(0.001) # If so, give the bot a chance to read a partial packet
+
+    async def handle(self, reader, writer):
+        """Answer a single connection."""
+        self.connections += 1 # Count the connection
+        try: # Make sure the connection is closed when done
+            if self.silent: # Check if the server should never answer
+                await reader.read() # If so, wait until the bot gives up
+                return
+
+            packet_id, data = await self.read_packet(reader) # Read the handshake
+            stream = asyncio.StreamReader() # Decode the handshake
+            stream.feed_data(data)
+            stream.feed_eof()
+            version = await decode_varint(stream) # The protocol version
+            host = (await stream.readexactly(await decode_varint(stream))).decode() # The host the bot connected to
+            port = int.from_bytes(await stream.readexactly(2), 'big') # The port the bot connected to
+            self.handshakes.append((version, host, port, await decode_varint(stream))) # Keep the handshake
+
+            await self.read_packet(reader) # Read the status request
+            status = json.dumps(self.status).encode() # Encode the status
+            await self.write_packet(writer, 0x00, encode_varint(len(status)) + status) # Send the status
+
+            packet_id, payload = await self.read_packet(reader) # Read the ping
+            await self.write_packet(writer, 0x01, payload) # Answer it with a pong
+        except (asyncio.IncompleteReadError, ConnectionError): # Catch if the bot hung up
+            pass # If so, there is nothing left to do
+        finally:
+            writer.close() # Close the connection
+
+class FakeRconServer:
+    """A fake Minecraft server that answers RCON like a real one does. Responses longer than 4096 bytes
+    are split over several packets, unknown packet types are answered with a single packet saying so,
+    and the connection is closed after the stop command, after which on_stop is called if it is set.
+    Every command that was run is kept, and the connections and logins are counted."""
+
+    def __init__(self, password, on_stop=None, host='127.0.0.1'):
+        """Initialize the variables. The server isn't listening until start is called."""
+        self.password = password # The RCON password
+        self.host = host # The address to listen on
+        self.on_stop = on_stop # Called when the stop command is run
+        self.connections = 0 # The amount of connections accepted
+        self.logins = 0 # The amount of logins, whether they succeeded or not
+        self.commands = [] # The commands that were run
+        self.writers = [] # The open connections
+        self.server = None # The listening server
+        self.port = None # The port the server is listening on
+
+    async def start(self):
+        """Start listening on a free port."""
+        self.server = await asyncio.start_server(self.handle, self.host, 0) # Start listening
+        self.port = self.server.sockets[0].getsockname()[1] # Get the port that was picked
+
+    async def close(self):
+        """Stop listening, and close every connection."""
+        self.drop() # Close every connection
+        self.server.close() # Stop listening
+        await self.server.wait_closed() # Wait until it has stopped
+
+    def drop(self):
+        """Close every open connection, like a server that restarted."""
+        for writer in self.writers: # Loop through each connection
+            writer.close() # Close it
+        self.writers.clear()
+
+    def send(self, writer, request_id, type, payload):
+        """Send a packet."""
+        data = struct.pack('<ii', request_id, type) + payload.encode() + b'\x00\x00' # Build the packet
+        writer.write(struct.pack('<i', len(data)) + data) # Send it, with its length in front
+
+    def respond(self, command):
+        """Get the response to a command."""
+        if command.startswith('big '): # Check if a big response is asked for
+            return 'x' * int(command[4:]) # If so, respond with that many bytes
+        return f'Ran {command}' # Otherwise, just say the command was run
+
+    async def handle(self, reader, writer):
+        """Answer a single connection."""
+        self.connections += 1 # Count the connection
+        self.writers.append(writer) # Keep the connection, so it can be dropped
+        logged_in = False # Whether the connection has logged in
+        try: # Make sure the connection is closed when done
+            while True: # Keep answering until the connection is closed
+                length, = struct.unpack('<i', await reader.readexactly(4)) # Read the length of a packet
+                data = await reader.readexactly(length) # Read the packet
+                request_id, type = struct.unpack('<ii', data[:8]) # Get its ID and type
+                payload = data[8:-2].decode() # Get its payload
+
+                if type == 3: # Check if this is a login
+                    self.logins += 1 # Count the login
+                    logged_in = payload == self.password # Check the password
+                    self.send(writer, request_id if logged_in else -1, 2, '') # Answer the login
+                elif not logged_in: # Check if the connection hasn't logged in
+                    break # If so, hang up, like a real server does
+                elif type == 2: # Check if this is a command
+                    self.commands.append(payload) # Keep the command
+                    if payload == 'stop': # Check if the server should stop
+                        if self.on_stop: # Check if anything should happen when it does
+                            self.on_stop() # If so, do it
+                        break # Hang up without answering, like a real server does
+                    response = self.respond(payload) # Get the response
+                    for start in range(0, max(len(response), 1), 4096): # Split it over as many packets as needed
+                        self.send(writer, request_id, 0, response[start:start + 4096]) # Send each packet
+                else:
+                    self.send(writer, request_id, 0, f'Unknown request {type:x}') # Answer unknown packets, which the bot uses to find the end of a response
+                await writer.drain() # Wait for the answers to be sent
+        except (asyncio.IncompleteReadError, ConnectionError): # Catch if the bot hung up
+            pass # If so, there is nothing left to do
+        finally:
+            writer.close() # Close the connection
+            if writer in self.writers: # Check if the connection is still kept
+                self.writers.remove(writer) # If so, forget it
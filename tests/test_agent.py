@@ -0,0 +1,92 @@
+"""Tests for running servers on several nodes. Every agent is a copy of the bot of its own, with a
+server directory of its own, answering the bot on a free port on localhost."""
+
+# Import
+import asyncio
+import unittest
+
+from tests import support
+
+SCRIPT = 'echo "Done (0.1s)!"\nsleep 0.5\n' # A server that is ready right away, then exits
+
+class AgentTest(unittest.IsolatedAsyncioTestCase):
+    """Tests for the bot talking to agents."""
+
+    async def start_agent(self, servers, **options):
+        """Load an agent with the given servers, and start it answering on a free port. Returns the
+        agent and its address."""
+        server_dir = support.make_server_dir(self)
+        for name in servers: # Loop through each server of the agent
+            support.make_server(server_dir, name, SCRIPT)
+        agent = support.load_bot(self, server_dir, node_secret='secret', ready_timeout=10, **options) # Load the agent
+
+        listener = await asyncio.start_server(agent.handle_agent_request, '127.0.0.1', 0) # Start answering the bot
+        self.addAsyncCleanup(self.stop_agent, agent, listener) # Stop when the test is done
+        return agent, f'127.0.0.1:{listener.sockets[0].getsockname()[1]}' # Return the agent and its address
+
+    async def stop_agent(self, agent, listener):
+        """Stop an agent answering, and wait for its servers to exit."""
+        listener.close() # Stop answering
+        await listener.wait_closed()
+        await self.wait_servers(agent) # Wait for its servers to exit
+
+    async def wait_servers(self, bot):
+        """Wait for the servers a bot or agent started to exit."""
+        await asyncio.gather(*(server.task for server in list(bot.supervisor.servers.values()))) # Wait for every supervised server to exit
+
+    async def asyncSetUp(self):
+        """Start two agents, one with a name and one without, and load the bot with both of them and
+        one that isn't running."""
+        self.alpha, alpha_address = await self.start_agent(['alpha-only', 'shared'], node_name='alpha')
+        self.beta, self.beta_address = await self.start_agent(['beta-only', 'shared'])
+
+        server_dir = support.make_server_dir(self)
+        support.make_server(server_dir, 'local', SCRIPT)
+        self.bot = support.load_bot(self, server_dir, node_secret='secret', node_name='bot', ready_timeout=10, nodes=f'{alpha_address}, {self.beta_address}, 127.0.0.1:1')
+        self.addAsyncCleanup(self.wait_servers, self.bot) # Wait for the servers of the bot to exit when the test is done
+
+    async def test_catalog(self):
+        """The catalogs of the nodes are merged, nodes that can't be reached are left out, and unnamed
+        agents are named after their address."""
+        servers = await self.bot.cluster.refresh()
+        self.assertEqual([server['name'] for server in servers], ['alpha-only', 'beta-only', 'local', 'shared'])
+        self.assertEqual([node.name for node in self.bot.cluster.locations['shared']], ['alpha', self.beta_address])
+        self.assertEqual([node.name for node in self.bot.cluster.locations['local']], ['bot'])
+
+    async def test_errors(self):
+        """Errors on an agent are raised as the same kind of exception on the bot."""
+        await self.bot.cluster.refresh()
+        node = self.bot.cluster.locations['alpha-only'][0]
+        with self.assertRaises(ValueError):
+            await node.call('start', name='missing')
+        with self.assertRaises(RuntimeError):
+            await node.call('wait_ready', name='alpha-only')
+        with self.assertRaises(ValueError):
+            await node.call('nonsense')
+
+    async def test_wrong_secret(self):
+        """An agent refuses a bot with the wrong secret."""
+        node = self.bot.RemoteNode(self.beta_address, 'guess')
+        with self.assertRaises(PermissionError):
+            await node.call('catalog')
+
+    async def test_run(self):
+        """The run command starts every server on the node that has it, and waits for them to be ready."""
+        ctx = support.StubContext()
+        await self.bot.run.callback(ctx, 'alpha-only', 'beta-only', 'local', 'shared', 'missing')
+        lines = ctx.messages[-1].content.strip('`').splitlines()
+        self.assertRegex(lines[1], r'^alpha-only\s+running on alpha, ready in')
+        self.assertRegex(lines[2], rf'^beta-only\s+running on {self.beta_address}, ready in')
+        self.assertRegex(lines[3], r'^local\s+running on bot, ready in')
+        self.assertRegex(lines[4], r'^shared\s+running on (alpha|127\.0\.0\.1:\d+), ready in')
+        self.assertRegex(lines[5], r'^missing\s+not found')
+
+        self.assertIn('alpha-only', self.alpha.supervisor.startup_times)
+        self.assertIn('beta-only', self.beta.supervisor.startup_times)
+        self.assertIn('local', self.bot.supervisor.startup_times)
+
+        await self.bot.cluster.refresh()
+        self.assertIs(self.bot.cluster.running['beta-only'], self.bot.cluster.locations['beta-only'][0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+"""Tests for the server catalog."""
+
+# Import
+from os import path
+import shutil
+import threading
+import time
+import unittest
+
+from tests import support
+
+class CatalogTest(unittest.TestCase):
+    """Tests for reading the server catalog."""
+
+    def setUp(self):
+        """Load the bot with a couple of servers."""
+        self.server_dir = support.make_server_dir(self)
+        for name in ('a', 'b'): # Loop through each server
+            support.make_server(self.server_dir, name, metadata={'ip': f'{name}.example'})
+        self.bot = support.load_bot(self, self.server_dir, catalog_refresh_interval=0)
+        self.catalog = self.bot.catalog
+
+    def test_refresh(self):
+        """Servers are found, and added and removed servers are noticed."""
+        self.catalog.refresh()
+        self.assertEqual([server['name'] for server in self.catalog.list()], ['a', 'b'])
+        self.assertEqual(self.catalog.get('a')['ip'], 'a.example')
+
+        support.make_server(self.server_dir, 'c')
+        shutil.rmtree(path.join(self.server_dir, 'a'))
+        self.catalog.refresh()
+        self.assertEqual([server['name'] for server in self.catalog.list()], ['b', 'c'])
+        self.assertIsNone(self.catalog.get('a'))
+        self.assertFalse(self.catalog.has_dir('a'))
+
+    def test_read_during_refresh(self):
+        """Reading the catalog doesn't wait for a refresh in another thread, and sees the catalog from
+        before the refresh until it is done."""
+        self.catalog.refresh()
+        support.make_server(self.server_dir, 'c')
+
+        refresh_dir = self.catalog.refresh_dir
+        def slow_refresh_dir(*args):
+            """Refresh a directory slowly, like on a busy disk."""
+            time.sleep(0.5)
+            refresh_dir(*args)
+        self.catalog.refresh_dir = slow_refresh_dir
+
+        refresh = threading.Thread(target=self.catalog.refresh)
+        refresh.start()
+        time.sleep(0.1) # Let the refresh get going
+        started = time.monotonic()
+        self.assertEqual(self.catalog.get('a')['name'], 'a')
+        self.assertFalse(self.catalog.has_dir('c'))
+        self.assertEqual(len(self.catalog.list()), 2)
+        self.assertLess(time.monotonic() - started, 0.1)
+
+        refresh.join()
+        self.assertTrue(self.catalog.has_dir('c'))
+
+if __name__ == '__main__':
+    unittest.main()
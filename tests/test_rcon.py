@@ -0,0 +1,126 @@
+"""Tests for RCON, the connection pool and the commands using it, against a fake server."""
+
+# Import
+import asyncio
+import os
+import subprocess
+import sys
+import unittest
+
+from tests import support
+
+class RconTest(unittest.IsolatedAsyncioTestCase):
+    """Tests for sending commands over RCON."""
+
+    async def asyncSetUp(self):
+        """Start a fake server, and load the bot with a server that points at it."""
+        self.rcon = support.FakeRconServer('secret', on_stop=self.on_stop) # Create the fake server
+        await self.rcon.start() # Start it
+        self.addAsyncCleanup(self.rcon.close) # Close it when the test is done
+        self.stopped = [] # The times the fake server was stopped
+
+        server_dir = support.make_server_dir(self)
+        support.make_server(server_dir, 'rc', properties={'enable-rcon': 'true', 'rcon.port': self.rcon.port, 'rcon.password': 'secret'})
+        support.make_server(server_dir, 'wrong', properties={'enable-rcon': 'true', 'rcon.port': self.rcon.port, 'rcon.password': 'guess'})
+        support.make_server(server_dir, 'disabled', properties={'enable-rcon': 'false'})
+        self.bot = support.load_bot(self, server_dir)
+        self.addAsyncCleanup(self.close_pool)
+
+    async def close_pool(self):
+        """Close every connection in the pool of the bot."""
+        for name in list(self.bot.rcon_pool.connections): # Loop through each connection
+            self.bot.rcon_pool.close(name) # Close it
+        if self.bot.rcon_pool.reaper: # Check if idle connections are being closed
+            self.bot.rcon_pool.reaper.cancel() # If so, stop
+
+    def on_stop(self):
+        """Called when the fake server is stopped."""
+        self.stopped.append(True) # Count the stop
+
+    async def test_command(self):
+        """A command is run, and its response is returned."""
+        self.assertEqual(await self.bot.rcon_pool.command('rc', 'list'), 'Ran list')
+        self.assertEqual(self.rcon.commands, ['list'])
+
+    async def test_long_response(self):
+        """A response split over several packets is put back together, up to the end marker."""
+        response = await self.bot.rcon_pool.command('rc', 'big 10000')
+        self.assertEqual(response, 'x' * 10000)
+        self.assertEqual(await self.bot.rcon_pool.command('rc', 'list'), 'Ran list') # The marker's own answer isn't left behind for the next command
+
+    async def test_connection_reused(self):
+        """Commands, even sent at the same time, share a single logged in connection."""
+        responses = await asyncio.gather(*(self.bot.rcon_pool.command('rc', f'say {index}') for index in range(5)))
+        self.assertEqual(responses, [f'Ran say {index}' for index in range(5)])
+        await self.bot.rcon_pool.command('rc', 'list')
+        self.assertEqual((self.rcon.connections, self.rcon.logins), (1, 1))
+
+    async def test_reconnect(self):
+        """A connection the server has closed is opened again, and the command is sent once more."""
+        await self.bot.rcon_pool.command('rc', 'list')
+        self.rcon.drop() # Close the connection from the server's side
+        await asyncio.sleep(0.05)
+        self.assertEqual(await self.bot.rcon_pool.command('rc', 'list'), 'Ran list')
+        self.assertEqual(self.rcon.connections, 2)
+
+    async def test_wrong_password(self):
+        """A wrong password raises a PermissionError, which is described to the user."""
+        with self.assertRaises(PermissionError) as caught:
+            await self.bot.rcon_pool.command('wrong', 'list')
+        self.assertIn('password', self.bot.describe_rcon_error(caught.exception))
+        self.assertEqual(self.rcon.commands, [])
+
+    async def test_not_enabled(self):
+        """A server without RCON enabled, or that doesn't exist, raises a ValueError."""
+        for name in ('disabled', 'missing'):
+            with self.assertRaises(ValueError):
+                await self.bot.rcon_pool.command(name, 'list')
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'needs all of 127.0.0.0/8 on the loopback interface')
+    async def test_server_ip(self):
+        """RCON is reached on the server-ip of a server if it is set, and on localhost if it isn't or
+        the server listens on every address."""
+        other = support.FakeRconServer('secret', host='127.0.0.2') # A server that only listens on another address
+        await other.start()
+        self.addAsyncCleanup(other.close)
+        server_dir = self.bot.server_dir
+        support.make_server(server_dir, 'bound', properties={'server-ip': '127.0.0.2', 'enable-rcon': 'true', 'rcon.port': other.port, 'rcon.password': 'secret'})
+        support.make_server(server_dir, 'everywhere', properties={'server-ip': '0.0.0.0', 'enable-rcon': 'true', 'rcon.port': self.rcon.port, 'rcon.password': 'secret'})
+
+        self.assertEqual(await self.bot.rcon_pool.command('bound', 'list'), 'Ran list')
+        self.assertEqual(other.commands, ['list'])
+        self.assertEqual(await self.bot.rcon_pool.command('everywhere', 'list'), 'Ran list')
+        self.assertEqual(self.rcon.commands, ['list'])
+
+    async def test_cmd(self):
+        """The cmd command sends a command to several servers, and shows each response."""
+        ctx = support.StubContext()
+        await self.bot.cmd.callback(ctx, 'rc,disabled', command='say hi')
+        content = '\n'.join(message.content for message in ctx.messages)
+        self.assertIn('Ran say hi', content)
+        self.assertIn('RCON is not enabled for the server', content)
+
+    @unittest.skipIf(os.name == 'nt', 'uses sleep to stand in for a server')
+    async def test_stop_unsupervised(self):
+        """A server that is running, but wasn't started by this bot, is stopped and waited for through
+        the process registry."""
+        process = subprocess.Popen(['sleep', '30']) # A process standing in for the server
+        self.addCleanup(process.kill)
+        self.rcon.on_stop = process.terminate # Stopping the fake server stops the process
+        self.bot.registry.register('rc', process.pid) # Register the process, like one that kept running while the bot was restarted
+
+        ctx = support.StubContext()
+        await self.bot.stop.callback(ctx, 'rc')
+        self.assertEqual(ctx.messages[-1].content, 'Server "rc" stopped.')
+        self.assertEqual(self.rcon.commands, ['stop'])
+        self.assertIsNone(self.bot.registry.get_pid('rc'))
+
+    async def test_stop_unknown_process(self):
+        """A server the bot knows no process for is sent the stop command, and the reply says so."""
+        ctx = support.StubContext()
+        await self.bot.stop.callback(ctx, 'rc')
+        self.assertEqual(ctx.messages[-1].content, 'Server "rc" was sent the stop command.')
+        self.assertEqual(self.stopped, [True])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+"""Tests for the Server List Ping protocol and the status command, against a fake server."""
+
+# Import
+import asyncio
+import unittest
+
+from tests import support
+
+STATUS = { # The status the fake server sends
+    'version': {'name': '1.20.1', 'protocol': 763},
+    'players': {'online': 3, 'max': 20},
+    'description': {'text': '§aHello ', 'extra': [{'text': 'world'}, '§l!']},
+}
+
+class VarIntTest(unittest.IsolatedAsyncioTestCase):
+    """Tests for encoding and decoding VarInts."""
+
+    def setUp(self):
+        """Load the bot."""
+        self.bot = support.load_bot(self, support.make_server_dir(self))
+
+    async def decode(self, data):
+        """Decode a VarInt with the bot."""
+        reader = asyncio.StreamReader() # Put the data in a stream
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await self.bot.read_varint(reader) # Decode it
+
+    def test_known_encodings(self):
+        """VarInts are encoded like the protocol documents them."""
+        self.assertEqual(self.bot.pack_varint(0), b'\x00')
+        self.assertEqual(self.bot.pack_varint(127), b'\x7f')
+        self.assertEqual(self.bot.pack_varint(128), b'\x80\x01')
+        self.assertEqual(self.bot.pack_varint(25565), b'\xdd\xc7\x01')
+        self.assertEqual(self.bot.pack_varint(2 ** 31 - 1), b'\xff\xff\xff\xff\x07')
+        self.assertEqual(self.bot.pack_varint(-1), b'\xff\xff\xff\xff\x0f')
+
+    async def test_round_trip(self):
+        """Decoding an encoded VarInt gives back the number, as an unsigned 32 bit number."""
+        for value in (0, 1, 127, 128, 255, 300, 25565, 2 ** 21, 2 ** 31 - 1):
+            self.assertEqual(await self.decode(self.bot.pack_varint(value)), value)
+            self.assertEqual(await self.decode(support.encode_varint(value)), value)
+        self.assertEqual(await self.decode(self.bot.pack_varint(-1)), 2 ** 32 - 1)
+
+    async def test_too_long(self):
+        """A VarInt longer than five bytes is invalid."""
+        with self.assertRaises(ValueError):
+            await self.decode(b'\x80' * 5 + b'\x01')
+
+    def test_flatten_motd(self):
+        """Chat components are joined into plain text, without formatting codes."""
+        self.assertEqual(self.bot.flatten_motd(STATUS['description']), 'Hello world!')
+        self.assertEqual(self.bot.flatten_motd('§cPlain'), 'Plain')
+        self.assertEqual(self.bot.flatten_motd(None), '')
+
+class PingTest(unittest.IsolatedAsyncioTestCase):
+    """Tests for pinging a fake server."""
+
+    def setUp(self):
+        """Load the bot."""
+        self.bot = support.load_bot(self, support.make_server_dir(self))
+
+    async def serve(self, **options):
+        """Start a fake server, which is closed when the test is done."""
+        server = support.FakeSlpServer(STATUS, **options) # Create the fake server
+        await server.start() # Start it
+        self.addAsyncCleanup(server.close) # Close it when the test is done
+        return server # Return the fake server
+
+    async def test_ping(self):
+        """The status of the server is parsed, and the handshake asks for the status."""
+        server = await self.serve()
+        info = await self.bot.ping_server('127.0.0.1', server.port)
+        self.assertEqual((info['online'], info['max'], info['motd'], info['version']), (3, 20, 'Hello world!', '1.20.1'))
+        self.assertGreaterEqual(info['latency'], 0)
+        self.assertEqual(server.handshakes, [(2 ** 32 - 1, '127.0.0.1', server.port, 1)])
+
+    async def test_split_packets(self):
+        """Packets that arrive a byte at a time are put back together."""
+        server = await self.serve(chunk=1)
+        info = await self.bot.ping_server('127.0.0.1', server.port)
+        self.assertEqual(info['motd'], 'Hello world!')
+
+    async def test_big_status(self):
+        """A status bigger than a single read, with a multi-byte length, is read in full."""
+        server = await self.serve()
+        server.status = dict(STATUS, description='x' * 100000)
+        info = await self.bot.ping_server('127.0.0.1', server.port)
+        self.assertEqual(len(info['motd']), 100000)
+
+    async def test_timeout(self):
+        """A server that never answers times out."""
+        server = await self.serve(silent=True)
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.bot.ping_server('127.0.0.1', server.port, timeout=0.2)
+
+    async def test_offline(self):
+        """A server that isn't listening can't be pinged."""
+        server = await self.serve()
+        port = server.port
+        await server.close()
+        with self.assertRaises(OSError):
+            await self.bot.ping_server('127.0.0.1', port)
+
+class StatusCommandTest(unittest.IsolatedAsyncioTestCase):
+    """Tests for the status command."""
+
+    async def test_status(self):
+        """Every server is listed as online, offline or unknown, and asking twice at the same time only
+        pings the servers once."""
+        online = support.FakeSlpServer(STATUS) # A server that is online
+        await online.start()
+        self.addAsyncCleanup(online.close)
+
+        server_dir = support.make_server_dir(self)
+        support.make_server(server_dir, 'online', metadata={'ip': f'127.0.0.1:{online.port}'})
+        support.make_server(server_dir, 'offline', metadata={'ip': '127.0.0.1:1'})
+        support.make_server(server_dir, 'unknown')
+        bot = support.load_bot(self, server_dir, status_timeout=1)
+
+        first, second = support.StubContext(), support.StubContext()
+        await asyncio.gather(bot.status.callback(first), bot.status.callback(second))
+
+        self.assertEqual(online.connections, 1)
+        self.assertEqual(first.messages[0].content, second.messages[0].content)
+        lines = first.messages[0].content.splitlines()
+        self.assertIn('offline: offline', lines)
+        self.assertIn('unknown: unknown (no ip in metadata)', lines)
+        self.assertTrue(any(line.startswith('online: online, 3/20 players') for line in lines))
+        self.assertIn('\tHello world!', lines)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+"""Tests for running start files with the supervisor, and keeping their console output."""
+
+# Import
+import os
+from os import path
+import unittest
+
+from tests import support
+
+@unittest.skipIf(os.name == 'nt', 'runs shell scripts')
+class StartFileTest(unittest.IsolatedAsyncioTestCase):
+    """Tests for how start files are run."""
+
+    def setUp(self):
+        """Load the bot."""
+        self.server_dir = support.make_server_dir(self)
+        self.bot = support.load_bot(self, self.server_dir)
+
+    async def run_server(self, name, script, mode):
+        """Create a server with a start file, run it, and return its console output."""
+        support.make_server(self.server_dir, name, script)
+        file = path.join(self.server_dir, name, support.START_FILE)
+        os.chmod(file, mode)
+        await self.bot.supervisor.start(name, path.dirname(file), file)
+        await self.bot.supervisor.servers[name].task # Wait for the server to exit
+        return self.bot.supervisor.logs[name].tail(10)
+
+    async def test_shebang(self):
+        """An executable start file with a shebang is run with the shell it names."""
+        self.assertEqual(await self.run_server('bash', '#!/usr/bin/env bash\necho "${BASH_VERSION:+bash}"\n', 0o755), ['bash'])
+
+    async def test_not_executable(self):
+        """A start file that isn't executable, or has no shebang, is run with sh."""
+        self.assertEqual(await self.run_server('plain', 'echo hi\n', 0o644), ['hi'])
+        self.assertEqual(await self.run_server('bare', 'echo hi\n', 0o755), ['hi'])
+
+class ConsoleLogTest(unittest.TestCase):
+    """Tests for keeping console output."""
+
+    def test_stalled_log_file(self):
+        """Lines that don't fit in the queue of lines waiting for the log file are left out of it and
+        counted, and the log file says how many were left out once there is room again."""
+        bot = support.load_bot(self, support.make_server_dir(self), log_queue_lines=3)
+        bot.log_listener = True # Pretend the thread writing log files is running, but stalled
+        log = bot.ConsoleLog('stalled', file=path.join(support.make_server_dir(self), 'stalled.log'))
+        for index in range(5):
+            log.append(f'line {index}')
+        self.assertEqual(log.tail(5), [f'line {index}' for index in range(5)]) # Nothing is left out of the ring buffer
+        self.assertEqual(log.dropped, 2)
+
+        queued = [bot.log_queue.get_nowait().msg for _ in range(3)] # Let the disk catch up
+        log.append('line 5')
+        queued += [bot.log_queue.get_nowait().msg for _ in range(2)]
+        self.assertEqual(queued, ['line 0', 'line 1', 'line 2', '[2 lines were left out of the log file]', 'line 5'])
+        self.assertEqual(log.total_dropped, 2)
+
+if __name__ == '__main__':
+    unittest.main()